@@ -1,14 +1,24 @@
+import os
 import sys
 import logging
-import graph_tool
+import threading
 import time
 import re
+from contextlib import contextmanager
+import numpy as np
 from lib.pathfinder.util import manhattan, cardinal_dir, trader_enum, inverse_trader_enum
-from lib.pathfinder.importers import get_importer
+from lib.pathfinder.importers import get_importer, is_prospector_export
+from lib.pathfinder.ores import OreIndex, load_ores
+from lib.pathfinder.names import NameIndex
+from lib.pathfinder.overlay import Overlay
+from lib.pathfinder.csr import CSRGraph, IS_TL
+from lib.pathfinder.workers import RoutePool
 from lib.pathfinder.config import config
+from lib.pathfinder.navgraph import find_vertices, distances, position, save_graph, journal_change, mark_changed, \
+    compact_graph, Categories, GridIndex
+from lib.pathfinder.journal import journal_path
 from textual.message_pump import MessagePump
 from graph_tool import GraphView
-from graph_tool.util import find_vertex
 from graph_tool.topology import shortest_path, shortest_distance
 
 
@@ -21,15 +31,26 @@ class MasterCommander(MessagePump):
     def __init__(self, parent, graph=None):
         super().__init__(parent)
         self.graph_commander = GraphCommander(graph)
+        self.import_thread = None
+        self.draw_thread = None
+        self.last_route = None
         self.commands = {
             'quit': self.do_quit,
             'debug': self.do_debug,
             'route': self.do_route,
             'import': self.do_import,
             'closest': self.do_find_closest,
+            'ore': self.do_ore,
+            'draw': self.do_draw,
+            'tl': self.do_tl,
+            'bench': self.do_bench,
+            'checkpoint': self.do_checkpoint,
+            'compact': self.do_compact,
             'stats': self.do_stats,
             'help': self.do_help
         }
+        if config.drawgraph:
+            self.do_draw([])
 
 
     def process(self, user_input):
@@ -67,29 +88,149 @@ class MasterCommander(MessagePump):
             logging.debug(message)
 
     def do_route(self, args):
-        if not len(args) == 2:
-            logging.info("usage: route  <from> <to>")
+        """Usage: route <from> <to> \[<via> ...]
+
+        Stops are visited in the given order, e.g. route home trader1 trader2 home
+        """
+        if len(args) < 2:
+            logging.info(self.do_route.__doc__)
             return
         if not self.graph_commander.graph:
             logging.error("Searching requires a Graph to be loaded")
             return
-        origin = self.graph_commander.parse_coord(args.pop(0))
-        destination = self.graph_commander.parse_coord(args.pop(0))
-        if not origin or not destination:
+        stops = [self.graph_commander.parse_coord(arg) for arg in args]
+        if not all(stops):
             logging.error("Aborting find route.")
             return
-        vertex_list, edge_list = self.graph_commander.find_path(origin, destination)
-        description = self.graph_commander.narrate_path(vertex_list, edge_list)
+        legs = self.graph_commander.find_route(stops)
+        self.last_route = [step for steps in legs for step in steps]
+        description = self.graph_commander.narrate_route(legs)
         logging.info(description)
 
     def do_import(self, args):
         if not args:
             logging.info("usage: import <filepath>")
             return
+        if self.import_thread and self.import_thread.is_alive():
+            logging.warning("An import is already running, try again once it is done.")
+            return
         filename = ' '.join(args)
-        logging.info("importing may take some time...")
-        self.graph_commander.do_import(filename)
-        logging.info("import done.")
+        logging.info("importing in the background, routing keeps using the current graph meanwhile...")
+
+        def run_import():
+            # Nothing above this thread would report it, an uncaught error would just end the import silently
+            try:
+                self.graph_commander.do_import(filename)
+            except Exception:
+                logging.exception(f"import of {filename} failed, the graph was left unchanged")
+                return
+            logging.info("import done.")
+
+        self.import_thread = threading.Thread(target=run_import, daemon=True)
+        self.import_thread.start()
+
+    def do_draw(self, args):
+        """Usage: draw \[zoom] | draw route
+
+        Render map tiles of all or the given zoom level to the tile directory,
+        only tiles changed since they were last drawn are redrawn.
+        draw route renders the last route found.
+        """
+        if self.draw_thread and self.draw_thread.is_alive():
+            logging.warning("Still drawing, try again once it is done.")
+            return
+        if not self.graph_commander.graph:
+            logging.error("Drawing requires a Graph to be loaded")
+            return
+        if args and args[0] == 'route':
+            if not self.last_route:
+                logging.error("No route to draw yet.")
+                return
+            task = lambda: self.graph_commander.draw_route(self.last_route)
+        else:
+            try:
+                zooms = [int(arg) for arg in args] or None
+            except ValueError:
+                logging.info(self.do_draw.__doc__)
+                return
+            task = lambda: self.graph_commander.draw(zooms)
+        self.draw_thread = threading.Thread(target=task, daemon=True)
+        self.draw_thread.start()
+
+    def do_tl(self, args):
+        """Usage: tl disable <pos> | tl enable <pos> | tl add <from> <to>
+
+        Mark the translocator at pos as broken or repaired, or add a new translocator pair
+        """
+        if not self.graph_commander.graph:
+            logging.error("Changing translocators requires a Graph to be loaded")
+            return
+        if self.import_thread and self.import_thread.is_alive():
+            logging.warning("An import is running, try again once it is done.")
+            return
+        if len(args) == 2 and args[0] in ('disable', 'enable'):
+            pos = self.graph_commander.parse_coord(args[1])
+            if pos:
+                self.graph_commander.set_tl_disabled(pos, args[0] == 'disable')
+        elif len(args) == 3 and args[0] == 'add':
+            origin = self.graph_commander.parse_coord(args[1])
+            destination = self.graph_commander.parse_coord(args[2])
+            if origin and destination:
+                self.graph_commander.add_tl(origin, destination)
+        else:
+            logging.info(self.do_tl.__doc__)
+
+    def do_bench(self, args):
+        """Usage: bench \[count]
+
+        Route between random positions with both routing backends and compare
+        """
+        if not self.graph_commander.graph:
+            logging.error("Benchmarking requires a Graph to be loaded")
+            return
+        try:
+            num = int(args[0]) if args else 20
+        except ValueError:
+            logging.info(self.do_bench.__doc__)
+            return
+        results, worker_time = self.graph_commander.benchmark(num)
+        gt_times, csr_times, same = zip(*results)
+        logging.info(f"graph_tool: {np.mean(gt_times) * 1000:.1f}ms per route, "
+                     f"csr: {np.mean(csr_times) * 1000:.1f}ms per route, "
+                     f"{sum(same)} of {len(same)} distances identical")
+        if worker_time is not None:
+            logging.info(f"{config.route_workers} workers: {worker_time * 1000:.1f}ms per route in parallel")
+
+    def do_checkpoint(self, args):
+        """Usage: checkpoint
+
+        Save the whole graph and empty the change journal
+        """
+        if not self.graph_commander.graph:
+            logging.error("There is no Graph to save")
+            return
+        if self.import_thread and self.import_thread.is_alive():
+            logging.error("Wait for the running import to finish first")
+            return
+        self.graph_commander.checkpoint()
+        logging.info(f"Saved {config.data_file}")
+
+    def do_compact(self, args):
+        """Usage: compact
+
+        Drop leftovers of old queries, merge vertices at the same position and parallel edges
+        """
+        if not self.graph_commander.graph:
+            logging.error("There is no Graph to compact")
+            return
+        if self.import_thread and self.import_thread.is_alive():
+            logging.error("Wait for the running import to finish first")
+            return
+        (vertices, new_vertices), (edges, new_edges), (size, new_size) = self.graph_commander.compact()
+        logging.info(f"""Compacted graph
+        {vertices} -> {new_vertices} Nodes ({vertices - new_vertices} removed)
+        {edges} -> {new_edges} Edges ({edges - new_edges} removed)
+        {size // 1024} -> {new_size // 1024} KiB on disk""")
 
     def do_find_closest(self, args):
         """Usage: closest \[tradetype] \[distance] <pos>
@@ -115,14 +256,40 @@ class MasterCommander(MessagePump):
         for trader_type, trader_name, coord, dist in closest:
             logging.info(f"{trader_type} {trader_name} {coord} {dist}m")
 
+    def do_ore(self, args):
+        """Usage: ore <name> <min-density> <pos> \[radius]
+
+        List prospecting readings with at least min-density ‰ of an ore,
+        closest by travel distance first
+        """
+        if len(args) not in (3, 4):
+            logging.info(self.do_ore.__doc__)
+            return
+        ore = args[0]
+        try:
+            min_density = float(args[1])
+            radius = int(args[3]) if len(args) == 4 else 1000
+        except ValueError:
+            logging.info(self.do_ore.__doc__)
+            return
+        pos = self.graph_commander.parse_coord(args[2])
+        if not pos:
+            return
+        for coord, density, dist in self.graph_commander.closest_ores(ore, min_density, pos, radius):
+            logging.info(f"{ore} {density:.2f}‰ {coord} {dist}m")
+
     def do_stats(self, args):
         """Print various statistics"""
         graph = self.graph_commander.graph
         info = f"""Graph currently has
         {graph.num_vertices()} Nodes total
         {graph.num_edges()} Edges total
-        {GraphView(graph,vfilt=graph.vp.is_tl).num_vertices()} Translocators
-        {GraphView(graph,vfilt=graph.vp.is_trader).num_vertices()} Traders        
+        {len(self.graph_commander.categories.tl)} Translocators
+        {len(self.graph_commander.categories.traders)} Traders
+        """
+        if 'pruned_edges' in graph.gp:
+            info += f"""{graph.num_edges() + graph.gp.pruned_edges} Edges before sparsifying
+        {graph.num_edges()} Edges after sparsifying
         """
         logging.info(info)
 
@@ -143,89 +310,320 @@ class GraphCommander:
     def __init__(self, graph):
         # TODO: Generate Graph on none
         self.graph = graph
-
-    def link_vertex(self, u, maxdist=config.link_dist_tl, graph=None):
+        self.lock = threading.Lock()  # Guards self.graph against queries and swaps by imports
+        self.scratch_edges = []
+        self.ores = load_ores(config.ore_file)
+        self.names = None
+        self.categories = None
+        self.grid = None
+        self.overlay = None
+        self.csr = None
+        self.workers = None
+        self.refresh(graph)
+
+    def refresh(self, graph):
+        """Make graph the current graph, along with indexes derived from it
+
+        Indexes are built before taking the lock, so queries only wait for the swap itself.
+        """
+        names = NameIndex.from_graph(graph)
+        categories = Categories(graph)
+        grid = self.build_grid(graph)
+        overlay = None
+        if graph and config.routing_backend == 'overlay':
+            if config.overlay_cell_size < 8 * config.link_dist_tl:
+                logging.warning(f"overlay_cell_size {config.overlay_cell_size} is small compared to link_dist_tl "
+                                f"{config.link_dist_tl}, most vertices will border another cell and the overlay "
+                                f"skips little. Use at least {8 * config.link_dist_tl}.")
+            overlay = (self.overlay or Overlay(config.overlay_cell_size)).update(graph)
+            logging.info(f"{overlay.boundary_fraction():.0%} of all vertices are overlay boundary vertices")
+        csr = None
+        if graph and config.routing_backend == 'csr':
+            csr = CSRGraph.from_graph(graph)
+        workers = None
+        if csr and config.route_workers:
+            # Running workers pick up the new export by themselves
+            csr.export(config.csr_dir)
+            csr = CSRGraph.open(config.csr_dir, writable=True)
+            workers = self.workers or RoutePool(config.csr_dir, config.route_workers)
+        with self.lock:
+            self.graph = graph
+            self.names = names
+            self.categories = categories
+            self.grid = grid
+            self.overlay = overlay
+            self.csr = csr
+            self.workers, old_workers = workers, self.workers
+        if old_workers and old_workers is not workers:
+            old_workers.close()
+
+    @staticmethod
+    def build_grid(graph):
+        """Range index over all TL, traders and landmarks, used for linking single vertices"""
+        if not graph:
+            return None
+        vp = graph.vp
+        vertices = np.flatnonzero(vp.is_tl.a.astype(bool) | vp.is_trader.a.astype(bool) | vp.is_landmark.a.astype(bool))
+        return GridIndex(vp.x.a[vertices], vp.z.a[vertices], config.link_dist_tl), vertices
+
+    def routable(self):
+        """Return the graph to search in, without disabled edges"""
+        disabled = self.graph.ep.disabled.a
+        if not disabled.any():
+            return self.graph
+        return GraphView(self.graph, efilt=disabled == 0)
+
+    @contextmanager
+    def scratch(self):
+        """Lock the graph for a query and undo everything the query adds to it
+
+        Queries attach their endpoints as temporary vertices and edges,
+        those are removed again once the block is left.
+        """
+        with self.lock:
+            num_vertices = self.graph.num_vertices()
+            self.scratch_edges = []
+            try:
+                yield
+            finally:
+                for edg in reversed(self.scratch_edges):
+                    if int(edg.source()) < num_vertices and int(edg.target()) < num_vertices:
+                        self.graph.remove_edge(edg)  # Edges of temporary vertices vanish along with them
+                self.scratch_edges = []
+                if self.graph.num_vertices() > num_vertices:
+                    self.graph.remove_vertex(list(range(num_vertices, self.graph.num_vertices())))
+
+    def add_scratch_edge(self, u, v, weight):
+        edg = self.graph.add_edge(u, v)
+        self.graph.ep.weight[edg] = weight
+        self.scratch_edges.append(edg)
+        return edg
+
+    def link_vertex(self, u, maxdist=config.link_dist_tl, targets=None):
         """Link given vertext to all Nodes in range
 
         Considers only TL-Nodes by default
+
+        :param targets: array of candidate vertices
         """
 
-        if not graph:
-            graph = graph_tool.GraphView(self.graph, vfilt=self.graph.vp.is_tl)
-        u_pos = self.graph.vp.coord[u]
-        for vt, vt_pos in graph.iter_vertices([self.graph.vp.coord]):
-            dist = manhattan(u_pos, vt_pos)
-
-            if dist < maxdist and vt != u:
-                # logging.debug(f"{u}->{v} {dist}")
-                edg = self.graph.add_edge(u, vt)
-                self.graph.ep.weight[edg] = dist
+        if targets is None:
+            targets = self.categories.tl
+        dist = distances(self.graph, position(self.graph, u), targets)
+        in_range = (dist < maxdist) & (targets != int(u))
+        for vt, d in zip(targets[in_range].tolist(), dist[in_range].tolist()):
+            # logging.debug(f"{u}->{v} {dist}")
+            self.add_scratch_edge(u, vt, d)
         return
 
-    def find_or_add(self, position):
-        vt = graph_tool.util.find_vertex(self.graph, self.graph.vp.coord, position)
-        if vt:
-            if len(vt) > 1:
-                logging.warning(f"Found {len(vt)} vertices for position {tuple(position)}!")
-            vt = vt[0]
-            logging.debug(f"found {position} to be preexisting as vertex {vt}")
+    def find_or_add(self, pos):
+        vt = find_vertices(self.graph, pos)
+        if vt.size:
+            if vt.size > 1:
+                logging.warning(f"Found {vt.size} vertices for position {tuple(pos)}!")
+            vt = self.graph.vertex(vt[0])
+            logging.debug(f"found {pos} to be preexisting as vertex {vt}")
         else:
             vt = self.graph.add_vertex()
-            self.graph.vp.coord[vt] = position
+            self.graph.vp.x[vt] = pos[0]
+            self.graph.vp.z[vt] = pos[1]
         return vt
 
-    def find_path(self, origin, destination):
-
-        if not self.graph:
-            logging.error("No Graph-Data available. Try importing some data first before searching in it")
-            return
+    def find_path(self, origin, destination, backend=None):
+        """Find the shortest route between two positions
 
-        # obtain origin vertex
-        ovt = self.find_or_add(origin)
+        :param backend: routing backend to use, config.routing_backend by default
+        :return: list of steps (from, to, weight, is_tl)
+        """
+        legs = self.find_route([origin, destination], backend)
+        return legs[0] if legs else None
 
-        # obtain destination vertex
-        dvt = self.find_or_add(destination)
+    def find_route(self, stops, backend=None):
+        """Find the shortest route visiting all stops in order
 
-        # add the trivial connection (walking from origin to destination)
-        edg = self.graph.add_edge(ovt, dvt)
-        self.graph.ep.weight[edg] = manhattan(origin, destination)
+        :param stops: list of at least two positions
+        :param backend: routing backend to use, config.routing_backend by default
+        :return: list of steps (from, to, weight, is_tl) for each leg
+        """
 
-        coord = self.graph.vp.coord
-        weight = self.graph.ep.weight
-        e_is_tl = self.graph.ep.is_tl
+        if not self.graph:
+            logging.error("No Graph-Data available. Try importing some data first before searching in it")
+            return
 
-        # Link the temporary vertices for start and endpoint
-        maxdist = manhattan(coord[ovt], coord[dvt])
+        backend = backend or config.routing_backend
+        maxdist = sum(manhattan(a, b) for a, b in zip(stops, stops[1:]))
         logging.info(f"Trivial distance would be {maxdist} to walk")
-        self.link_vertex(ovt, maxdist)
-        self.link_vertex(dvt, maxdist)
         starttime = time.time()
-        vertex_list, edge_list = shortest_path(self.graph, ovt, dvt, weight)
+        if backend == 'csr' and self.workers:
+            legs = self.workers.route(stops).result()
+        elif backend == 'csr':
+            legs = self.csr.route(stops)
+        else:
+            legs = self._find_route_graph(stops, use_overlay=backend == 'overlay')
         logging.info(f"search took {time.time() - starttime} seconds")
-        return vertex_list, edge_list
+        return legs
+
+    def _find_path_graph(self, origin, destination, use_overlay=False):
+        return self._find_route_graph([origin, destination], use_overlay)[0]
+
+    def _find_route_graph(self, stops, use_overlay=False):
+        with self.scratch():
+            vertices = [self.find_or_add(pos) for pos in stops]
+
+            # add the trivial connections (walking from stop to stop) and link every stop
+            # as far as the longer one of its legs
+            radius = {}
+            for u, v, a, b in zip(vertices, vertices[1:], stops, stops[1:]):
+                trivial = manhattan(a, b)
+                self.add_scratch_edge(u, v, trivial)
+                radius[int(u)] = max(radius.get(int(u), 0), trivial)
+                radius[int(v)] = max(radius.get(int(v), 0), trivial)
+            overlay = self.overlay if use_overlay else None
+            for vt, maxdist in radius.items():
+                self.link_vertex(self.graph.vertex(vt), maxdist)
+
+            legs = []
+            if overlay:
+                weight = self.graph.ep.weight
+                extra = [(int(e.source()), int(e.target()), weight[e]) for e in self.scratch_edges]
+                # The search has to expand every cell the extra edges lead into, see Overlay
+                open_cells = {overlay.cell_at(position(self.graph, vt)) for edge in extra for vt in edge[:2]}
+                open_cells.update(overlay.cell_at(pos) for pos in stops)
+                for u, v in zip(vertices, vertices[1:]):
+                    hops = overlay.shortest_path(int(u), int(v), extra, open_cells)
+                    legs.append([(position(self.graph, a), position(self.graph, b), w, is_tl)
+                                 for a, b, w, is_tl in hops])
+                return legs
+            routable = self.routable()
+            for u, v in zip(vertices, vertices[1:]):
+                vertex_list, edge_list = shortest_path(routable, u, v, self.graph.ep.weight)
+                legs.append(self.path_steps(vertex_list, edge_list))
+            return legs
+
+    def benchmark(self, num=20):
+        """Route between random positions with both the graph_tool and the csr backend
+
+        :return: list of (graph_tool seconds, csr seconds, distances equal),
+                 and the seconds per route of the worker pool running all of them in parallel, if there is one
+        """
+        rng = np.random.default_rng()
+        x, z = self.graph.vp.x.a, self.graph.vp.z.a
+        csr = self.csr or CSRGraph.from_graph(self.graph)
+        queries = []
+        results = []
+        for _ in range(num):
+            origin = (int(rng.integers(x.min(), x.max() + 1)), int(rng.integers(z.min(), z.max() + 1)))
+            destination = (int(rng.integers(x.min(), x.max() + 1)), int(rng.integers(z.min(), z.max() + 1)))
+            queries.append([origin, destination])
+            starttime = time.time()
+            gt_steps = self._find_path_graph(origin, destination)
+            gt_time = time.time() - starttime
+            starttime = time.time()
+            csr_steps = csr.shortest_path(origin, destination)
+            csr_time = time.time() - starttime
+            same = sum(step[2] for step in gt_steps) == sum(step[2] for step in csr_steps)
+            results.append((gt_time, csr_time, same))
+        worker_time = None
+        if self.workers:
+            starttime = time.time()
+            self.workers.routes(queries)
+            worker_time = (time.time() - starttime) / num
+        return results, worker_time
+
+    def path_steps(self, vertex_list, edge_list):
+        """Convert a path through the graph to a list of steps (from, to, weight, is_tl)"""
+        weight = self.graph.ep.weight
+        e_is_tl = self.graph.ep.is_tl
+        positions = [position(self.graph, vt) for vt in vertex_list]
+        return [(positions[i], positions[i + 1], weight[edg], bool(e_is_tl[edg]))
+                for i, edg in enumerate(edge_list)]
 
     def closest_traders(self, origin, trader_type=None, maxdist=500):
+        if config.routing_backend == 'csr':
+            if self.workers:
+                found = self.workers.closest_traders(origin, trader_type, maxdist, config.link_dist_tl).result()
+            else:
+                found = self.csr.closest_traders(origin, trader_type, maxdist, config.link_dist_tl)
+            closest = []
+            for vt, dist in found:
+                closest.append((trader_enum[self.graph.vp.trader_type[vt]], self.graph.vp.trader_name[vt],
+                                position(self.graph, vt), dist))
+            return sorted(closest, key=lambda x: x[-1])
+        with self.scratch():
+            return self._closest_traders(origin, trader_type, maxdist)
+
+    def _closest_traders(self, origin, trader_type, maxdist):
         vt = self.find_or_add(origin)
-        if trader_type:
-            trader_view = GraphView(self.graph, vfilt=lambda v: self.graph.vp.trader_type[v] == trader_type)
-        else:
-            trader_view = GraphView(self.graph, vfilt=self.graph.vp.is_trader)
+        traders = self.categories.traders_of(trader_type) if trader_type else self.categories.traders
         self.link_vertex(vt, min(maxdist, config.link_dist_tl))
-        self.link_vertex(vt, maxdist, trader_view)
+        self.link_vertex(vt, maxdist, traders)
         weights = self.graph.ep.weight
-        dist_map = shortest_distance(self.graph, vt, weights=weights, max_dist=maxdist)
+        dist_map = shortest_distance(self.routable(), vt, weights=weights, max_dist=maxdist)
         closest = []
-        for vt, dist in trader_view.iter_vertices([dist_map]):
+        for vt, dist in zip(traders.tolist(), dist_map.a[traders].tolist()):
             if dist < maxdist:
                 trader_type = trader_enum[self.graph.vp.trader_type[vt]]
                 trader_name = self.graph.vp.trader_name[vt]
-                coord = tuple(self.graph.vp.coord[vt])
+                coord = position(self.graph, vt)
                 closest.append((trader_type, trader_name, coord, dist))
         return sorted(closest, key=lambda x: x[-1])
 
 
-    def do_import(self, filename, save=True):
+    def closest_ores(self, ore, min_density, origin, maxdist=1000, limit=10):
+        """Find prospecting readings of an ore by travel distance
+
+        Every TL reachable within maxdist is a starting point for walking to
+        the readings around it.
+
+        :return: list of (position, density, distance), closest first
+        """
+        ores = self.ores  # Imports swap in a new index, stick to one for the whole query
+        column = ores.column(ore)
+        if column is None:
+            logging.error(f"No readings for {ore}, known ores are {' '.join(ores.ores)}")
+            return []
+        with self.scratch():
+            vt = self.find_or_add(origin)
+            self.link_vertex(vt, min(maxdist, config.link_dist_tl))
+            dist_map = shortest_distance(self.routable(), vt, weights=self.graph.ep.weight, max_dist=maxdist)
+            reached = np.flatnonzero(self.graph.vp.is_tl.a.astype(bool) & (dist_map.a <= maxdist))
+            starts = [(origin, 0)] + [(position(self.graph, tl), int(dist_map.a[tl])) for tl in reached]
+
+        best = np.full(len(ores), np.iinfo(np.int64).max)
+        for pos, dist in starts:
+            idx, walk = ores.nearby(pos, maxdist - dist)
+            qualifies = column[idx] >= min_density
+            np.minimum.at(best, idx[qualifies], walk[qualifies] + dist)
+        found = np.flatnonzero(best <= maxdist)
+        found = found[np.argsort(best[found], kind='stable')][:limit]
+        return [(tuple(ores.positions[i].tolist()), float(column[i]), int(best[i])) for i in found]
+
+    def import_ores(self, filename, save=True):
+        """Import prospecting readings into the ore index"""
         importer = get_importer(filename, self.graph)
+        try:
+            importer.do_import()
+        except IOError as e:
+            logging.error(str(e))
+            return
+        ores = OreIndex(self.ores.ores, self.ores.positions, self.ores.densities)  # Queries keep the old one
+        ores.add(importer.ores, importer.positions, importer.densities)
+        self.ores = ores
+        logging.info(f"Ore index now holds {len(ores)} readings.")
+        if save:
+            ores.save(config.ore_file)
+
+    def do_import(self, filename, save=True):
+        """Import a file into a private copy of the graph and swap it in when done
+
+        Queries keep running on the current graph in the meantime.
+        """
+        if is_prospector_export(filename):
+            self.import_ores(filename, save)
+            return
+        with self.lock:
+            graph = self.graph.copy() if self.graph else None
+        importer = get_importer(filename, graph)
         if not importer:
             return
         existing = importer.graph.num_vertices()
@@ -235,14 +633,165 @@ class GraphCommander:
             logging.error(str(e))
             return
         importer.make_connections()
+        if config.sparsify:
+            importer.sparsify()
         new = importer.graph.num_vertices()
         logging.info(f"Added {new - existing} Nodes for a total of {new}.")
+        regions = importer.changed_regions()
+        if len(regions):
+            mark_changed(importer.graph, regions)
         if save:
-            importer.graph.save(config.data_file)
-        self.graph = importer.graph
+            # Nobody else sees the new graph yet, no lock needed
+            if self.graph:
+                journal_change(importer.graph, config.data_file, importer.changed_vertices(),
+                               config.journal_max_size)
+            else:
+                save_graph(importer.graph, config.data_file)
+        self.refresh(importer.graph)
+
+    def find_tl(self, pos, maxdist=10):
+        """Return the TL vertex closest to pos, None if there is none within maxdist"""
+        index, vertices = self.grid
+        found, dist = index.nearby(pos, maxdist)
+        found = vertices[found]
+        tls = self.graph.vp.is_tl.a[found].astype(bool)
+        if not tls.any():
+            logging.error(f"No translocator found at {pos}")
+            return None
+        return int(found[tls][np.argmin(dist[tls])])
+
+    def set_tl_disabled(self, pos, disabled=True):
+        """Flip the disabled flag of both edges of the TL pair at pos"""
+        with self.lock:
+            vt = self.find_tl(pos)
+            if vt is None:
+                return
+            edges = self.graph.get_all_edges(vt, [self.graph.edge_index, self.graph.ep.is_tl])
+            edges = edges[edges[:, 3] == 1]
+            if not len(edges):
+                logging.error(f"TL at {pos} has no partner")
+                return
+            self.graph.ep.disabled.a[edges[:, 2]] = disabled
+            partner = int(edges[0, 1]) if int(edges[0, 0]) == vt else int(edges[0, 0])
+            if self.overlay:
+                self.overlay.set_disabled(vt, partner, disabled)
+            if self.csr:
+                self.csr.set_disabled(vt, partner, disabled)
+            logging.info(f"TL {position(self.graph, vt)} <-> {position(self.graph, partner)} "
+                         f"{'disabled' if disabled else 'enabled'}")
+            self.graph_changed([vt, partner])
+
+    def add_tl(self, origin, destination):
+        """Add a TL pair and link only its two ends to their surroundings"""
+        with self.lock:
+            graph = self.graph
+            if find_vertices(graph, origin).size or find_vertices(graph, destination).size:
+                logging.error(f"There already is something at {origin} or {destination}")
+                return
+            ends = [graph.add_vertex(), graph.add_vertex()]
+            for vt, pos in zip(ends, (origin, destination)):
+                graph.vp.x[vt], graph.vp.z[vt] = pos
+                graph.vp.is_tl[vt] = True
+            for _ in range(2):  # Same as importers, one edge for each direction
+                edg = graph.add_edge(*ends)
+                graph.ep.weight[edg] = config.tl_cost
+                graph.ep.is_tl[edg] = True
+
+            ends = [int(vt) for vt in ends]
+            new_edges = [(ends[0], ends[1], config.tl_cost, True)]
+
+            index, vertices = self.grid
+            vp = graph.vp
+            reach = max(config.link_dist_tl, config.link_dist_trader, config.link_dist_landmark)
+            for vt, pos in zip(ends, (origin, destination)):
+                found, dist = index.nearby(pos, reach)
+                found = vertices[found]
+                maxdist = np.select([vp.is_tl.a[found].astype(bool), vp.is_trader.a[found].astype(bool)],
+                                    [config.link_dist_tl, config.link_dist_trader], config.link_dist_landmark)
+                linked = (0 < dist) & (dist < maxdist)  # Same rules as make_connections
+                for other, d in zip(found[linked].tolist(), dist[linked].tolist()):
+                    edg = graph.add_edge(vt, other)
+                    graph.ep.weight[edg] = d
+                    new_edges.append((vt, other, d, False))
+            # The new ends are not in the index yet, walking between them is linked like any two TL
+            d = manhattan(origin, destination)
+            if 0 < d < config.link_dist_tl:
+                edg = graph.add_edge(*ends)
+                graph.ep.weight[edg] = d
+                new_edges.append((ends[0], ends[1], d, False))
+            logging.info(f"TL {origin} <-> {destination} added")
+
+            # Only the two new vertices go into the existing indexes
+            self.categories.add(graph, ends)
+            index.insert(vp.x.a[ends], vp.z.a[ends])
+            self.grid = index, np.append(vertices, ends)
+            if self.overlay:
+                self.overlay.add([origin, destination], new_edges)
+            if self.csr:
+                self.csr.add([origin, destination], [IS_TL, IS_TL], [-1, -1], new_edges)
+            self.graph_changed(ends)
+
+    def graph_changed(self, vertices):
+        """Update caches and persist the graph after an in-place edit around vertices
+
+        Must be called with the lock held.
+        """
+        x = self.graph.vp.x.a[vertices]
+        z = self.graph.vp.z.a[vertices]
+        margin = max(config.link_dist_tl, config.link_dist_trader, config.link_dist_landmark)
+        # One box per vertex, the two ends of a TL may be far apart
+        mark_changed(self.graph, np.column_stack([x - margin, z - margin, x + margin, z + margin]))
+        if self.workers:
+            # csr maps the export writable, so flags are already shared. New vertices go to a side file
+            self.csr.write_added(config.csr_dir)
+        journal_change(self.graph, config.data_file, vertices, config.journal_max_size)
+
+    def compact(self):
+        """Replace the graph by a compacted copy and save it in full
+
+        :return: (before, after) pairs of vertex count, edge count and bytes on disk
+        """
+        def disk_size():
+            return sum(os.path.getsize(path) for path in (config.data_file, journal_path(config.data_file))
+                       if os.path.exists(path))
+
+        size = disk_size()
+        with self.lock:
+            old = self.graph
+            graph = compact_graph(old)
+        if graph.num_vertices():
+            x, z = graph.vp.x.a, graph.vp.z.a
+            mark_changed(graph, [(x.min(), z.min(), x.max(), z.max())])  # Vertex ids changed everywhere
+        save_graph(graph, config.data_file)
+        self.refresh(graph)
+        return ((old.num_vertices(), graph.num_vertices()), (old.num_edges(), graph.num_edges()),
+                (size, disk_size()))
+
+    def checkpoint(self):
+        """Write a full snapshot of the graph, folding the journal into it"""
+        with self.lock:
+            save_graph(self.graph, config.data_file)
+
+    def draw(self, zooms=None):
+        """Render map tiles from a snapshot of the graph"""
+        from lib.pathfinder.tiles import TileRenderer, MAX_ZOOM
+        with self.lock:
+            graph = self.graph.copy()
+        TileRenderer(config.tile_dir).render(graph, zooms or range(MAX_ZOOM + 1))
+
+    def draw_route(self, steps):
+        from lib.pathfinder.tiles import TileRenderer
+        with self.lock:
+            graph = self.graph.copy()
+        TileRenderer(config.tile_dir).render_route(graph, steps, os.path.join(config.tile_dir, 'route.png'))
+
+    def complete(self, prefix):
+        """Complete a landmark or trader name for the prompt"""
+        return self.names.complete(prefix)
 
     def parse_coord(self, coord_str):
-        graph = self.graph
+        with self.lock:  # Names and graph must come from the same swap, vertex ids differ between graphs
+            graph, names = self.graph, self.names
         try:
             x, y = re.split(',', coord_str)
             x = int(x)
@@ -251,40 +800,65 @@ class GraphCommander:
         except ValueError:
             logging.debug("coordinate could not be parsed as x,y")
 
-        view = graph_tool.GraphView(graph, vfilt=graph.vp.is_landmark)
-        result = find_vertex(view, graph.vp.landmark_name, coord_str)
+        result = names.exact(coord_str)
         if not result:
-            logging.error(f'could not find a location for {coord_str}')
-            return None
+            suggestions = names.fuzzy(coord_str)
+            if len(suggestions) == 1:
+                logging.info(f'assuming you meant {suggestions[0]}')
+                result = names.exact(suggestions[0])
+            else:
+                logging.error(f'could not find a location for {coord_str}')
+                if suggestions:
+                    logging.info(f'did you mean: {" ".join(suggestions[:5])}')
+                return None
         if len(result) > 1:
             logging.warning(f'found {len(result)} possible locations for {coord_str} choosing the first one')
-        return graph.vp.coord[result[0]]
+        return position(graph, result[0])
+
+    @staticmethod
+    def route_stats(steps):
+        """Return the walking distance and number of TL used of a list of steps"""
+        walked = sum(weight for _, _, weight, is_tl in steps if not is_tl)
+        return walked, sum(1 for step in steps if step[3])
 
-    def narrate_path(self, vertex_list, edge_list):
+    def narrate_path(self, steps, destination="your destination"):
         """Give textual description of a path
 
-        :param vertex_list: ordered list of vertices to visit
-        :param edge_list: ordered list of edges to traverse
+        :param steps: ordered list of steps (from, to, weight, is_tl) as given by find_path
         """
-        coord = self.graph.vp.coord
-        weight = self.graph.ep.weight
-        e_is_tl = self.graph.ep.is_tl
-        vert = tuple(coord[vertex_list.pop(0)])
         dist = 0
         step = 0
         num_tl = 0
-        route = f"\n{step}. You start at {vert}.\n"
-        while vertex_list:
+        route = f"\n{step}. You start at {steps[0][0]}.\n" if steps else ""
+        for oldvert, vert, weight, is_tl in steps:
             step += 1
-            edg = edge_list.pop(0)
-            oldvert = vert
-            vert = tuple(coord[vertex_list.pop(0)])
-            if e_is_tl[edg]:
+            if is_tl:
                 route += f"    translocate\n"
                 num_tl += 1
             else:
-                dist += weight[edg]
+                dist += weight
                 direction = cardinal_dir(oldvert, vert)
-                route += f"{step}. Move {direction} {weight[edg]}m from {oldvert} to {vert}.\n"
-        route += f"\nYou arrive at your destination after {(dist / 1000):.2f}km of travel using {num_tl} TL!"
+                route += f"{step}. Move {direction} {weight}m from {oldvert} to {vert}.\n"
+        route += f"\nYou arrive at {destination} after {(dist / 1000):.2f}km of travel using {num_tl} TL!"
+        return route
+
+    def narrate_route(self, legs):
+        """Give textual description of a route with several stops
+
+        :param legs: list of steps per leg as given by find_route
+        """
+        if len(legs) == 1:
+            return self.narrate_path(legs[0])
+        route = ""
+        for i, steps in enumerate(legs, 1):
+            destination = "your destination" if i == len(legs) else f"stop {i}"
+            route += f"\nLeg {i}:" + self.narrate_path(steps, destination) + "\n"
+        route += "\n"
+        total_dist = total_tl = 0
+        for i, steps in enumerate(legs, 1):
+            dist, num_tl = self.route_stats(steps)
+            total_dist += dist
+            total_tl += num_tl
+            route += f"Leg {i}: {(dist / 1000):.2f}km, {num_tl} TL\n"
+        route += f"Total: {(total_dist / 1000):.2f}km of travel using {total_tl} TL"
         return route
@@ -14,13 +14,21 @@ defaults = {
     'goal': None,
     'listlandmarks': False,
     'data': 'data/navgraph.gt',
+    'journal_max_size': 4000000,  # Bytes of journaled changes before the navgraph is saved in full
+    'ore_file': 'data/ores.npz',  # Prospecting readings
     'drawgraph': False,
+    'tile_dir': 'data/tiles',  # Rendered map tiles
     'dbfile': None,  # Import File
     'link_dist_tl': 10000,
     'link_dist_trader': 1000,
     'link_dist_landmark': 1000,
     'tl_cost': 0,
+    'sparsify': False,  # Drop walking edges between TL that are matched by a two-hop walk
     'global_offset': (500000, 50000),
+    'routing_backend': 'graph_tool',  # graph_tool: plain Dijkstra, overlay: partitioned multilevel search, csr: numpy arrays
+    'overlay_cell_size': 131072,  # Edge length of an overlay cell in blocks, keep it well above link_dist_tl
+    'route_workers': 0,  # Processes answering csr queries from a memory mapped export, 0 routes in-process
+    'csr_dir': 'data/csr',  # Memory mapped export of the navgraph for route workers
     'debugmode': True
 }
 
@@ -0,0 +1,349 @@
+"""
+Routing over the navgraph exported to compressed sparse row arrays.
+
+Only numpy and heapq are needed for searching, graph_tool is only used by the export.
+Query endpoints are never added to the arrays, they are attached as virtual
+vertices for the duration of a single search instead.
+
+An export directory holds one .npy file per array, so any number of processes
+can memory map the same export read-only instead of holding a copy each. One
+process may map it writable to flip edge flags in place, everyone else sees the
+change right away. Vertices and edges added later go to a small side file, see
+write_added.
+"""
+import os
+import shutil
+import uuid
+from heapq import heappush, heappop
+
+import numpy as np
+
+from lib.pathfinder.util import manhattan
+
+# Edge flags
+TL = 1
+DISABLED = 2
+
+# Vertex flags
+IS_TL = 1
+IS_TRADER = 2
+IS_LANDMARK = 4
+
+ADDED_FILE = 'added.npz'
+
+
+def _current(directory):
+    with open(os.path.join(directory, 'current')) as f:
+        return f.read().strip()
+
+
+class CSRGraph:
+    ARRAYS = ('indptr', 'indices', 'weights', 'flags', 'x', 'z', 'vflags', 'trader_type')
+    # Vertices and edges added after building the arrays, see add
+    PATCH = ('added_x', 'added_z', 'added_vflags', 'added_trader_type', 'added_edges')
+    __slots__ = ARRAYS + PATCH
+
+    def __init__(self, indptr, indices, weights, flags, x, z, vflags, trader_type):
+        """
+        :param indptr: (V + 1,) offsets of each vertex' edges into indices
+        :param indices: (2E,) neighbor of each edge slot, every undirected edge has two slots
+        :param weights: (2E,) weight per slot
+        :param flags: (2E,) edge flags per slot
+        :param x: (V,) positions
+        :param z: (V,) positions
+        :param vflags: (V,) vertex flags
+        :param trader_type: (V,) trader type, -1 for non-traders
+        """
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.flags = flags
+        self.x = x
+        self.z = z
+        self.vflags = vflags
+        self.trader_type = trader_type
+        self.added_x = np.empty(0, dtype=np.int32)
+        self.added_z = np.empty(0, dtype=np.int32)
+        self.added_vflags = np.empty(0, dtype=np.uint8)
+        self.added_trader_type = np.empty(0, dtype=np.int8)
+        self.added_edges = {}  # vertex -> [neighbor, weight, flags]
+
+    @classmethod
+    def from_graph(cls, graph):
+        """Export a graph_tool navgraph"""
+        num_vertices = graph.num_vertices()
+        edges = graph.get_edges([graph.ep.weight, graph.ep.is_tl, graph.ep.disabled])
+        src, dst = edges[:, 0], edges[:, 1]
+        flags = (edges[:, 3] * TL | edges[:, 4] * DISABLED).astype(np.uint8)
+        source = np.concatenate([src, dst])
+        order = np.argsort(source, kind='stable')
+        vp = graph.vp
+        vflags = (vp.is_tl.a * IS_TL | vp.is_trader.a * IS_TRADER | vp.is_landmark.a * IS_LANDMARK)
+        return cls(np.searchsorted(source[order], np.arange(num_vertices + 1)).astype(np.int64),
+                   np.concatenate([dst, src])[order].astype(np.int32),
+                   np.concatenate([edges[:, 2], edges[:, 2]])[order].astype(np.int32),
+                   np.concatenate([flags, flags])[order],
+                   vp.x.a.astype(np.int32), vp.z.a.astype(np.int32),
+                   vflags.astype(np.uint8), vp.trader_type.a.astype(np.int8))
+
+    def export(self, directory):
+        """Write the arrays as .npy files for memory mapping by CSRGraph.open
+
+        Every export goes to a fresh subdirectory and the *current* file is switched
+        over atomically once it is complete. Older exports are deleted, processes
+        that still have them mapped keep working on them until they reopen.
+        """
+        merged = self.merged()
+        os.makedirs(directory, exist_ok=True)
+        version = uuid.uuid4().hex
+        os.makedirs(os.path.join(directory, version))
+        for name in self.ARRAYS:
+            np.save(os.path.join(directory, version, f"{name}.npy"), getattr(merged, name))
+        pointer = os.path.join(directory, 'current')
+        with open(pointer + '.tmp', 'w') as f:
+            f.write(version)
+        os.replace(pointer + '.tmp', pointer)
+        for entry in os.listdir(directory):
+            if entry != version and os.path.isdir(os.path.join(directory, entry)):
+                shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+
+    def merged(self):
+        """Return a CSRGraph with the added vertices and edges folded into the arrays"""
+        if not len(self.added_x) and not self.added_edges:
+            return self
+        base = len(self.indptr) - 1
+        src = np.repeat(np.arange(base), np.diff(self.indptr))
+        hops = [(vt, nb, w, flag) for vt, hops in self.added_edges.items() for nb, w, flag in hops]
+        added = np.array(hops, dtype=np.int64).reshape(-1, 4)
+        src = np.append(src, added[:, 0])
+        order = np.argsort(src, kind='stable')
+        indptr = np.zeros(self.num_vertices + 1, dtype=self.indptr.dtype)
+        np.cumsum(np.bincount(src, minlength=self.num_vertices), out=indptr[1:])
+        return CSRGraph(indptr,
+                        np.append(self.indices, added[:, 1]).astype(self.indices.dtype)[order],
+                        np.append(self.weights, added[:, 2]).astype(self.weights.dtype)[order],
+                        np.append(self.flags, added[:, 3]).astype(self.flags.dtype)[order],
+                        self.column('x'), self.column('z'), self.column('vflags'), self.column('trader_type'))
+
+    @classmethod
+    def open(cls, directory, writable=False):
+        """Memory map the current export in directory, nothing is parsed or copied
+
+        :param writable: map the edge flags writable, set_disabled then changes the export itself
+        """
+        version = _current(directory)
+        graph = cls(*(np.load(os.path.join(directory, version, f"{name}.npy"),
+                              mmap_mode='r+' if writable and name == 'flags' else 'r')
+                      for name in cls.ARRAYS))
+        try:
+            with np.load(os.path.join(directory, version, ADDED_FILE)) as added:
+                graph.added_x, graph.added_z = added['x'], added['z']
+                graph.added_vflags, graph.added_trader_type = added['vflags'], added['trader_type']
+                for vt, nb, w, flag in added['edges'].tolist():
+                    graph.added_edges.setdefault(vt, []).append([nb, w, flag])
+        except FileNotFoundError:
+            pass
+        return graph
+
+    @staticmethod
+    def stamp(directory):
+        """Return something that changes whenever the current export or its added vertices and edges change"""
+        version = _current(directory)
+        try:
+            st = os.stat(os.path.join(directory, version, ADDED_FILE))
+        except FileNotFoundError:
+            return version, None
+        return version, st.st_ino, st.st_mtime_ns
+
+    def write_added(self, directory):
+        """Store the added vertices and edges next to the current export in directory
+
+        Only ever a handful of TL, so the file is rewritten as a whole.
+        """
+        hops = [(vt, nb, w, flag) for vt, hops in self.added_edges.items() for nb, w, flag in hops]
+        path = os.path.join(directory, _current(directory), ADDED_FILE)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, x=self.added_x, z=self.added_z, vflags=self.added_vflags,
+                     trader_type=self.added_trader_type, edges=np.array(hops, dtype=np.int64).reshape(-1, 4))
+        os.replace(path + '.tmp', path)
+
+    @property
+    def num_vertices(self):
+        return len(self.x) + len(self.added_x)
+
+    def column(self, name):
+        """Return a vertex array (x, z, vflags or trader_type) including added vertices"""
+        added = getattr(self, 'added_' + name)
+        return np.concatenate([getattr(self, name), added]) if len(added) else getattr(self, name)
+
+    def position(self, vt):
+        if vt < len(self.x):
+            return int(self.x[vt]), int(self.z[vt])
+        return int(self.added_x[vt - len(self.x)]), int(self.added_z[vt - len(self.x)])
+
+    def find_vertex(self, pos):
+        """Return the first vertex at pos, None if there is none"""
+        found = np.flatnonzero((self.column('x') == pos[0]) & (self.column('z') == pos[1]))
+        return int(found[0]) if found.size else None
+
+    def add(self, positions, vflags, trader_types, edges):
+        """Append vertices and add edges without rebuilding the arrays
+
+        :param positions: (x, z) of the new vertices, they get the next free ids
+        :param vflags: vertex flags of the new vertices
+        :param trader_types: trader type of the new vertices
+        :param edges: (u, v, weight, is_tl) of new edges
+        """
+        positions = np.asarray(positions, dtype=np.int32).reshape(-1, 2)
+        self.added_x = np.append(self.added_x, positions[:, 0])
+        self.added_z = np.append(self.added_z, positions[:, 1])
+        self.added_vflags = np.append(self.added_vflags, np.asarray(vflags, dtype=np.uint8))
+        self.added_trader_type = np.append(self.added_trader_type, np.asarray(trader_types, dtype=np.int8))
+        for u, v, w, is_tl in edges:
+            flag = TL if is_tl else 0
+            self.added_edges.setdefault(u, []).append([v, w, flag])
+            self.added_edges.setdefault(v, []).append([u, w, flag])
+
+    def set_disabled(self, u, v, disabled=True):
+        """Flip the disabled flag of the TL edges between u and v"""
+        for a, b in ((u, v), (v, u)):
+            if a < len(self.indptr) - 1:
+                lo, hi = self.indptr[a], self.indptr[a + 1]
+                slots = lo + np.flatnonzero((self.indices[lo:hi] == b) & ((self.flags[lo:hi] & TL) > 0))
+                if disabled:
+                    self.flags[slots] |= DISABLED
+                else:
+                    self.flags[slots] &= ~np.uint8(DISABLED)
+            for hop in self.added_edges.get(a, ()):
+                if hop[0] == b and hop[2] & TL:
+                    hop[2] = hop[2] | DISABLED if disabled else hop[2] & ~DISABLED
+
+    def link(self, vt, pos, mask, maxdist):
+        """Return (vertex, dist) for all vertices selected by mask closer than maxdist to pos, except vt"""
+        candidates = np.flatnonzero(mask)
+        x, z = self.column('x'), self.column('z')
+        dist = np.abs(x[candidates] - pos[0]) + np.abs(z[candidates] - pos[1])
+        in_range = (dist < maxdist) & (candidates != vt)
+        return zip(candidates[in_range].tolist(), dist[in_range].tolist())
+
+    def dijkstra(self, source, extra, target=None, max_dist=None):
+        """Search from source, stopping at target or max_dist
+
+        :param extra: vertex -> [(neighbor, weight)] of virtual edges added for this search only
+        :return: dist, pred dicts. pred maps to (previous vertex, weight, is_tl)
+        """
+        base = len(self.indptr) - 1
+        indptr, indices, weights, flags = self.indptr, self.indices, self.weights, self.flags
+        added = self.added_edges
+        dist = {source: 0}
+        pred = {}
+        heap = [(0, source)]
+        while heap:
+            d, vt = heappop(heap)
+            if vt == target:
+                break
+            if d > dist[vt]:
+                continue
+            hops = [(nb, w, 0) for nb, w in extra.get(vt, ())]
+            if vt < base:
+                lo, hi = indptr[vt], indptr[vt + 1]
+                hops += zip(indices[lo:hi].tolist(), weights[lo:hi].tolist(), flags[lo:hi].tolist())
+            if vt in added:
+                hops += added[vt]
+            for nb, w, flag in hops:
+                if flag & DISABLED:
+                    continue
+                nd = d + w
+                if max_dist is not None and nd > max_dist:
+                    continue
+                if nd < dist.get(nb, nd + 1):
+                    dist[nb] = nd
+                    pred[nb] = (vt, w, bool(flag & TL))
+                    heappush(heap, (nd, nb))
+        return dist, pred
+
+    def attach(self, positions):
+        """Resolve query positions to vertices, reusing existing ones like GraphCommander.find_or_add
+
+        :return: list of vertex ids, and their positions by id
+        """
+        ids = []
+        virtual = {}
+        for pos in positions:
+            vt = self.find_vertex(pos)
+            if vt is None:
+                vt = next((v for v, p in virtual.items() if p == tuple(pos)), None)
+            if vt is None:
+                vt = self.num_vertices + len(virtual)
+                virtual[vt] = tuple(pos)
+            ids.append(vt)
+        return ids, virtual
+
+    def shortest_path(self, origin, destination):
+        """Same search as GraphCommander.find_path with the graph_tool backend
+
+        :return: list of steps (from, to, weight, is_tl)
+        """
+        return self.route([origin, destination])[0]
+
+    def route(self, stops):
+        """Same search as GraphCommander.find_route with the graph_tool backend
+
+        All stops are attached once, then every leg is searched up to its next stop.
+
+        :return: list of steps (from, to, weight, is_tl) per leg
+        """
+        ids, virtual = self.attach(stops)
+        positions = dict(zip(ids, map(tuple, stops)))
+        extra = {}
+
+        def add(u, v, w):
+            extra.setdefault(u, []).append((v, w))
+            extra.setdefault(v, []).append((u, w))
+
+        radius = {}
+        for (u, v), (a, b) in zip(zip(ids, ids[1:]), zip(stops, stops[1:])):
+            trivial = manhattan(a, b)
+            add(u, v, trivial)  # the trivial connection
+            radius[u] = max(radius.get(u, 0), trivial)
+            radius[v] = max(radius.get(v, 0), trivial)
+        tls = (self.column('vflags') & IS_TL) > 0
+        for vt, maxdist in radius.items():
+            for tl, d in self.link(vt, positions[vt], tls, maxdist):
+                add(vt, tl, d)
+
+        def pos_of(vt):
+            return virtual[vt] if vt in virtual else self.position(vt)
+
+        legs = []
+        for ovt, dvt in zip(ids, ids[1:]):
+            _, pred = self.dijkstra(ovt, extra, target=dvt)
+            steps = []
+            vt = dvt
+            while vt != ovt:
+                prev, w, is_tl = pred[vt]
+                steps.append((pos_of(prev), pos_of(vt), w, is_tl))
+                vt = prev
+            legs.append(steps[::-1])
+        return legs
+
+    def closest_traders(self, origin, trader_type=None, maxdist=500, link_dist_tl=None):
+        """Same search as GraphCommander.closest_traders with the graph_tool backend
+
+        :return: list of (trader vertex, dist)
+        """
+        (vt,), _ = self.attach([origin])
+        vflags = self.column('vflags')
+        if trader_type:
+            traders = self.column('trader_type') == trader_type
+        else:
+            traders = (vflags & IS_TRADER) > 0
+        extra = {}
+        tl_dist = min(maxdist, link_dist_tl) if link_dist_tl else maxdist
+        for mask, dist in (((vflags & IS_TL) > 0, tl_dist), (traders, maxdist)):
+            for other, d in self.link(vt, origin, mask, dist):
+                extra.setdefault(vt, []).append((other, d))
+                extra.setdefault(other, []).append((vt, d))
+        dist, _ = self.dijkstra(vt, extra, max_dist=maxdist)
+        return [(other, d) for other, d in dist.items()
+                if other < self.num_vertices and traders[other] and d < maxdist]
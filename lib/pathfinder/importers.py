@@ -1,9 +1,10 @@
 
 import logging
 import re
-import graph_tool as gt
-from lib.pathfinder.util import manhattan, get_trader_type
+import numpy as np
+from lib.pathfinder.util import get_trader_type
 from lib.pathfinder.config import config
+from lib.pathfinder.navgraph import new_graph, find_vertices, distances, position, Categories
 
 
 from lib.pathfinder.datastructures import Node
@@ -24,18 +25,9 @@ class AbstractImporter():
         self.filepath = filepath
         self.graph = graph
         if not graph:
-            self.graph = gt.Graph(directed=False)
-            self.graph.vp['is_tl'] = self.graph.new_vertex_property('bool', val=False)
-            self.graph.vp['coord'] = self.graph.new_vertex_property('vector<int>')
-            self.graph.vp['elevation'] = self.graph.new_vertex_property('int', val=0)
-            self.graph.ep['weight'] = self.graph.new_edge_property('int', val=0)
-            self.graph.ep['is_tl'] = self.graph.new_edge_property('bool', val=False)
-            self.graph.vp['is_trader'] = self.graph.new_vertex_property('bool', val=False)
-            self.graph.vp['trader_name'] = self.graph.new_vertex_property('string')
-            self.graph.vp['trader_type'] = self.graph.new_vertex_property('int', val=-1)
-            self.graph.vp['is_landmark'] = self.graph.new_vertex_property('bool', val=False)
-            self.graph.vp['landmark_name'] = self.graph.new_vertex_property('string')
-            self.graph.vp['landmark_type'] = self.graph.new_vertex_property('int')
+            self.graph = new_graph()
+        self.first_new = self.graph.num_vertices()  # Vertices below this index were linked by a previous import
+        self.touched = set()  # Older vertices that got edges added or removed by this import
 
         print(self.graph)
     def do_import(self):
@@ -43,17 +35,19 @@ class AbstractImporter():
 
     def add_tl(self, origin, destination):
         """Create vertices for a given translocator-pair"""
-        if origin in self.graph.vp.coord:
+        ox, oy, oz = origin
+        dx, dy, dz = destination
+        if find_vertices(self.graph, (ox, oz)).size:
             logging.debug(f"TL {origin} to {destination} already known")
             return
         org_vt = self.graph.add_vertex()
         dst_vt = self.graph.add_vertex()
         oe = self.graph.add_edge(org_vt, dst_vt)
         ie = self.graph.add_edge(dst_vt, org_vt)
-        ox, oy, oz = origin
-        dx, dy, dz = destination
-        self.graph.vp.coord[org_vt] = (ox, oz)
-        self.graph.vp.coord[dst_vt] = (dx, dz)
+        self.graph.vp.x[org_vt] = ox
+        self.graph.vp.z[org_vt] = oz
+        self.graph.vp.x[dst_vt] = dx
+        self.graph.vp.z[dst_vt] = dz
         self.graph.vp.elevation[org_vt] = oy
         self.graph.vp.elevation[dst_vt] = dy
         self.graph.ep.weight[oe] = TL_COST
@@ -65,23 +59,25 @@ class AbstractImporter():
 
     def add_trader(self, pos, name, description):
         """Create Trader Vertex in the NavGraph"""
-        if pos in self.graph.vp.coord.get_2d_array([0, 1])[:, 1:]:
+        if find_vertices(self.graph, (pos[0], pos[2])).size:
             logging.debug(f"Adding Trader failed, already a node at {pos}")
             return
         vt = self.graph.add_vertex()
         self.graph.vp.is_trader[vt] = True
-        self.graph.vp.coord[vt] = (pos[0], pos[2])
+        self.graph.vp.x[vt] = pos[0]
+        self.graph.vp.z[vt] = pos[2]
         self.graph.vp.elevation[vt] = pos[1]
         self.graph.vp.trader_name[vt] = name
         self.graph.vp.trader_type[vt] = get_trader_type(description)
 
     def add_landmark(self, pos, name, landmark_type=None):
-        if pos in self.graph.vp.coord.get_2d_array([0, 1])[:, 1:]:
-                logging.debug(f"Adding Landmark failed, a node already exists at {pos}")
-                return
+        if find_vertices(self.graph, (pos[0], pos[2])).size:
+            logging.debug(f"Adding Landmark failed, a node already exists at {pos}")
+            return
         vt = self.graph.add_vertex()
         self.graph.vp.is_landmark[vt] = True
-        self.graph.vp.coord[vt] = (pos[0], pos[2])
+        self.graph.vp.x[vt] = pos[0]
+        self.graph.vp.z[vt] = pos[2]
         self.graph.vp.elevation[vt] = pos[1]
         self.graph.vp.landmark_name[vt] = name
         self.graph.vp.landmark_type[vt] = landmark_type
@@ -89,38 +85,105 @@ class AbstractImporter():
     def make_connections(self):
         """Create Edges in the NavGraph
 
-        TL are Linked to all other TL closer than *link_dist_tl*
+        TL are Linked to all other TL closer than *link_dist_tl*, the other end of their pair included
         Traders are Linked to all TL closer than *link_dist_trader*
+        Only pairs involving a vertex added by this import are considered,
+        everything else was linked (or deliberately pruned) before.
         """
 
-        trader_view = gt.GraphView(self.graph, vfilt=self.graph.vp.is_trader)
-        tl_view = gt.GraphView(self.graph, vfilt=self.graph.vp.is_tl)
-        landmark_view = gt.GraphView(self.graph, vfilt=self.graph.vp.is_landmark)
+        categories = Categories(self.graph)
         num = 0
 
-        def link(view1, view2, maxdist):
+        def link(sources, targets, maxdist):
+            """Link every new source to all targets and every new target to all older sources"""
             nonlocal num
-            for vt1, coord1 in view1.iter_vertices([self.graph.vp.coord]):
-                for vt2, coord2 in view2.iter_vertices([self.graph.vp.coord]):
-                    if self.graph.edge(vt1, vt2):
-                        continue  # no need to link what is already there
-                    dist = manhattan(coord1, coord2)
-                    if 0 < dist < maxdist:
-                        num += 1
-                        e = self.graph.add_edge(vt1, vt2)
-                        self.graph.ep.weight[e] = dist
+            pairs = [(vt, targets) for vt in sources[sources >= self.first_new].tolist()]
+            if sources is not targets:  # Otherwise the first pass already saw both directions
+                pairs += [(vt, sources[sources < self.first_new]) for vt in targets[targets >= self.first_new].tolist()]
+            for vt1, others in pairs:
+                dist = distances(self.graph, position(self.graph, vt1), others)
+                in_range = (0 < dist) & (dist < maxdist)
+                for vt2, d in zip(others[in_range].tolist(), dist[in_range].tolist()):
+                    if any(not self.graph.ep.is_tl[e] for e in self.graph.edge(vt1, vt2, all_edges=True)):
+                        continue  # no need to link what is already there, e.g. found from both ends
+                    num += 1
+                    self.touched.update((vt1, vt2))
+                    e = self.graph.add_edge(vt1, vt2)
+                    self.graph.ep.weight[e] = d
 
         # Link Translocators to each other via walk
-        link(tl_view, tl_view, TL_LINK_DIST)
+        link(categories.tl, categories.tl, TL_LINK_DIST)
 
         # Link Traders to Translocators
-        link(trader_view, tl_view, TRADER_LINK_DIST)
+        link(categories.traders, categories.tl, TRADER_LINK_DIST)
 
         # Link Landmarks to Translocators
-        link(landmark_view, tl_view, LANDMARK_LINK_DIST)
+        link(categories.landmarks, categories.tl, LANDMARK_LINK_DIST)
 
         logging.info(f"added {num} Edges")
 
+    def changed_regions(self):
+        """Return boxes (xmin, zmin, xmax, zmax) covering everything this import touched
+
+        One box per cell of the link distance holding a changed vertex, grown by that
+        distance since new edges reach as far. Far apart additions stay separate boxes.
+        """
+        vertices = self.changed_vertices()
+        margin = max(TL_LINK_DIST, TRADER_LINK_DIST, LANDMARK_LINK_DIST)
+        positions = np.column_stack([self.graph.vp.x.a[vertices], self.graph.vp.z.a[vertices]]).astype(np.int64)
+        cells = np.unique(positions // margin, axis=0)
+        return np.column_stack([cells * margin - margin, (cells + 1) * margin + margin])
+
+    def changed_vertices(self):
+        """Return all vertices whose properties or edges this import changed"""
+        touched = {vt for vt in self.touched if vt < self.first_new}
+        return sorted(touched) + list(range(self.first_new, self.graph.num_vertices()))
+
+    def sparsify(self):
+        """Remove walking edges between TL that are matched by a two-hop walk
+
+        Manhattan distance obeys the triangle inequality, so the edge u-v is redundant
+        whenever a TL k is linked to both and w(u,k) + w(k,v) <= w(u,v).
+        Both replacement edges are strictly shorter than the one they replace, so
+        removing all redundant edges at once keeps every shortest-path distance.
+
+        :return: number of removed edges
+        """
+        graph = self.graph
+        is_tl = graph.vp.is_tl.a.astype(bool)
+        edges = graph.get_edges([graph.edge_index, graph.ep.weight, graph.ep.is_tl])
+        walking = edges[(edges[:, 4] == 0) & is_tl[edges[:, 0]] & is_tl[edges[:, 1]]]
+
+        neighbors = {}
+        weights = {}
+        for u, v, _, w, _ in walking.tolist():
+            neighbors.setdefault(u, set()).add(v)
+            neighbors.setdefault(v, set()).add(u)
+            weights[(u, v)] = weights[(v, u)] = w
+
+        keep = graph.new_edge_property('bool', val=True)
+        pruned = 0
+        for u, v, idx, w, _ in walking.tolist():
+            if len(neighbors[u]) > len(neighbors[v]):
+                u, v = v, u
+            others = neighbors[v]
+            # Scan the smaller neighborhood and stop at the first witness instead of intersecting both
+            for k in neighbors[u]:
+                if k in others and weights[(u, k)] + weights[(k, v)] <= w:
+                    keep.a[idx] = False
+                    self.touched.update((u, v))
+                    pruned += 1
+                    break
+
+        graph.set_edge_filter(keep)
+        graph.purge_edges()
+        graph.set_edge_filter(None)
+        if 'pruned_edges' not in graph.gp:
+            graph.gp['pruned_edges'] = graph.new_graph_property('int', val=0)
+        graph.gp.pruned_edges += pruned
+        logging.info(f"removed {pruned} of {len(walking)} walking Edges between TL")
+        return pruned
+
 class CampaignCartographerImporter(AbstractImporter):
     """Manage Import from an Campaign-Cartographer export .json"""
     def do_import(self):
@@ -149,14 +212,35 @@ class CampaignCartographerImporter(AbstractImporter):
                     self.add_landmark(position, item['Title'].lower(), landmark_type=2)
 
 class ProspectorImporter(AbstractImporter):
-    def do_impport(self):
+    """Manage Import of prospecting readings
+
+    Readings do not become part of the navgraph, they are collected into
+    *ores*, *positions* and *densities* for the ore index instead.
+    """
+    def do_import(self):
         import json
         with open(self.filepath) as dbfile:
             db = json.load(dbfile)
+        positions = []
+        readings = []
         for item in db:
-            position = (item['X'], item['Z'])
+            position = (int(item['X']) - GLOBAL_OFFSET[0], int(item['Z']) - GLOBAL_OFFSET[1])
             _, _, ores = item['Message'].partition("Relative densities:")
-            ores = ores.split('\n')
+            densities = {}
+            for line in ores.split('\n'):
+                match = re.match(r'\s*([^:]+):.*\(([\d.]+)\s*‰\)', line)
+                if match:
+                    densities[match.group(1).strip().lower().replace(' ', '_')] = float(match.group(2))
+            positions.append(position)
+            readings.append(densities)
+        self.ores = sorted({ore for densities in readings for ore in densities})
+        self.positions = np.array(positions, dtype=np.int32).reshape(-1, 2)
+        self.densities = np.array([[densities.get(ore, 0) for ore in self.ores] for densities in readings],
+                                  dtype=np.float32).reshape(-1, len(self.ores))
+        logging.info(f"read {len(positions)} prospecting readings for {len(self.ores)} ores")
+
+    def make_connections(self):
+        pass  # Readings are not linked into the navgraph
 
 
 class GeojsonImporter(AbstractImporter):
@@ -177,9 +261,22 @@ class GeojsonImporter(AbstractImporter):
                 logging.debug(f"adding {origin}, {dest}")
 
 
+def is_prospector_export(filepath):
+    """Prospecting exports are plain json lists, CC exports are objects"""
+    if not filepath.endswith('.json'):
+        return False
+    try:
+        with open(filepath) as f:
+            return f.read(64).lstrip().startswith('[')
+    except IOError:
+        return False
+
+
 def get_importer(filepath, graph):
     if filepath.endswith('.geojson'):
         return GeojsonImporter(filepath, graph)
+    elif is_prospector_export(filepath):
+        return ProspectorImporter(filepath, graph)
     elif filepath.endswith('.json'):
         return CampaignCartographerImporter(filepath, graph)
     logging.error(f'Could not find a valid importer for {filepath}')
@@ -0,0 +1,165 @@
+"""
+Append-only journal of navgraph changes on top of a snapshot.
+
+The snapshot is the .gt file, the journal lives next to it as <snapshot>.journal.
+Every line is "<crc32> <json>". The first one is a header naming the snapshot the
+journal belongs to (the *journal_base* graph property), the following ones are records.
+
+A record carries a set of vertices with all their properties and every edge
+touching them. Replaying it appends missing vertices, replaces the edges around
+the listed vertices and sets their properties, so records stay proportional to
+the size of a change no matter how large the graph is.
+
+Lines are only ever appended and synced, a line cut short by a crash fails its
+checksum and ends the replay there.
+"""
+import json
+import logging
+import os
+import zlib
+
+import numpy as np
+
+JOURNAL_SUFFIX = '.journal'
+
+
+def journal_path(path):
+    return path + JOURNAL_SUFFIX
+
+
+def _encode(obj):
+    data = json.dumps(obj, separators=(',', ':'))
+    return f"{zlib.crc32(data.encode()):08x} {data}\n"
+
+
+def _decode(line):
+    """Return the object stored in a journal line, None if the line is damaged"""
+    checksum, _, data = line.rstrip('\n').partition(' ')
+    if not line.endswith('\n') or checksum != f"{zlib.crc32(data.encode()):08x}":
+        return None
+    return json.loads(data)
+
+
+def _plain(value):
+    """Convert a property value to something json can store"""
+    if isinstance(value, (str, bool, int, float)):
+        return value
+    if hasattr(value, 'item'):
+        return value.item()
+    return list(value)
+
+
+def sync_directory(path):
+    """Make a rename to path durable by syncing the directory holding it"""
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def start(path, base):
+    """Atomically replace the journal at path by an empty one belonging to snapshot base"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(_encode({'base': base}))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    sync_directory(path)
+
+
+def append(path, record):
+    """Append a record and make sure it hit the disk
+
+    :return: size of the journal afterwards
+    """
+    with open(path, 'a') as f:
+        f.write(_encode(record))
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+
+def read(path, base):
+    """Read all intact records of the journal at path
+
+    :return: list of records, whether the journal was intact and belongs to base
+    """
+    try:
+        with open(path) as f:
+            lines = f.readlines()
+    except IOError:
+        return [], False
+    header = _decode(lines[0]) if lines else None
+    if not header or header.get('base') != base:
+        logging.warning(f"Ignoring journal {path}, it does not belong to the loaded navgraph")
+        return [], False
+    records = []
+    for line in lines[1:]:
+        record = _decode(line)
+        if record is None:
+            logging.warning(f"Journal {path} is damaged after {len(records)} records, dropping the rest")
+            return records, False
+        records.append(record)
+    return records, True
+
+
+def record(graph, vertices):
+    """Capture the current state of vertices and all edges touching them
+
+    Only the change log entries of the newest version go along, see navgraph.mark_changed.
+    """
+    vertices = sorted(set(int(vt) for vt in vertices))
+    edges = [graph.get_all_edges(vt, [graph.edge_index]) for vt in vertices]
+    edges = np.concatenate(edges) if edges else np.empty((0, 3), dtype=np.int64)
+    _, first = np.unique(edges[:, 2], return_index=True)  # Edges between two listed vertices show up twice
+    edges = edges[np.sort(first)]
+    edge_props = sorted(graph.ep.keys())
+    columns = [graph.ep[name].a[edges[:, 2]].tolist() for name in edge_props]
+    changes = []
+    if 'changes' in graph.gp:
+        log = np.array(graph.gp.changes, dtype=np.int64).reshape(-1, 5)
+        changes = log[log[:, 0] == graph.gp.version].ravel().tolist()
+    return {
+        'vertices': [[vt, {name: _plain(prop[vt]) for name, prop in graph.vp.items()}] for vt in vertices],
+        'edge_props': edge_props,
+        'edges': [list(row) for row in zip(edges[:, 0].tolist(), edges[:, 1].tolist(), *columns)],
+        'graph': {name: [prop.value_type(), _plain(prop[graph])] for name, prop in graph.gp.items()
+                  if name not in ('journal_base', 'changes')},
+        'change': changes,
+    }
+
+
+def apply(graph, record):
+    """Replay a single record onto graph"""
+    vertices = [vt for vt, _ in record['vertices']]
+    missing = max(vertices, default=-1) + 1 - graph.num_vertices()
+    if missing > 0:
+        graph.add_vertex(missing)
+
+    touched = np.zeros(graph.num_vertices(), dtype=bool)
+    touched[vertices] = True
+    edges = graph.get_edges([graph.edge_index])
+    dropped = touched[edges[:, 0]] | touched[edges[:, 1]]
+    if dropped.any():
+        keep = graph.new_edge_property('bool', val=True)
+        keep.a[edges[dropped, 2]] = False
+        graph.set_edge_filter(keep)
+        graph.purge_edges()
+        graph.set_edge_filter(None)
+
+    for vt, props in record['vertices']:
+        for name, value in props.items():
+            graph.vp[name][vt] = value
+    if record['edges']:
+        graph.add_edge_list(record['edges'], eprops=[graph.ep[name] for name in record['edge_props']])
+    for name, (value_type, value) in record['graph'].items():
+        if name in graph.gp:
+            graph.gp[name] = value
+        else:
+            graph.gp[name] = graph.new_graph_property(value_type, val=value)
+    if record.get('change'):
+        if 'changes' not in graph.gp:
+            graph.gp['changes'] = graph.new_graph_property('vector<int>', val=[])
+        graph.gp.changes = list(graph.gp.changes) + record['change']
@@ -0,0 +1,112 @@
+"""
+Sorted index over landmark and trader names for exact, prefix and fuzzy lookup.
+
+Fuzzy lookup uses symmetric deletes: every name is stored under all strings that
+can be made from its first PREFIX characters by deleting up to MAX_EDITS of them.
+The prefixes of two names within MAX_EDITS edits of each other always share at
+least one such deletion, so a query only has to look up its own deletions and
+verify the few candidates found.
+"""
+from bisect import bisect_left, bisect_right
+from os.path import commonprefix
+
+
+MAX_EDITS = 2  # Largest edit distance fuzzy lookups support
+PREFIX = 8  # Only this much of a name is indexed, keeps the index at ~40 entries per name
+
+
+def _deletions(name, edits):
+    """Return all strings made from name by deleting up to edits characters, including name itself"""
+    found = {name}
+    level = {name}
+    for _ in range(edits):
+        level = {word[:i] + word[i + 1:] for word in level for i in range(len(word))}
+        found |= level
+    return found
+
+
+def _edit_distance(a, b, limit):
+    """Levenshtein distance of a and b, any value above limit is returned as limit + 1
+
+    Only the band of cells within limit of the diagonal is computed.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    over = limit + 1
+    previous = {j: j for j in range(min(len(b), limit) + 1)}
+    for i, char in enumerate(a, 1):
+        current = {}
+        for j in range(max(0, i - limit), min(len(b), i + limit) + 1):
+            if j == 0:
+                current[j] = i
+                continue
+            current[j] = min(previous.get(j, over) + 1, current.get(j - 1, over) + 1,
+                             previous.get(j - 1, over) + (char != b[j - 1]))
+        if min(current.values()) > limit:
+            return over
+        previous = current
+    return min(previous.get(len(b), over), over)
+
+
+class NameIndex:
+
+    def __init__(self, entries=()):
+        """
+        :param entries: iterable of (name, vertex)
+        """
+        entries = sorted((name.lower(), int(vt)) for name, vt in entries if name)
+        self.names = [name for name, _ in entries]
+        self.vertices = [vt for _, vt in entries]
+        self.deletes = {}  # deletion -> distinct names it was made from
+        for name in dict.fromkeys(self.names):
+            for deletion in _deletions(name[:PREFIX], MAX_EDITS):
+                self.deletes.setdefault(deletion, []).append(name)
+
+    @classmethod
+    def from_graph(cls, graph):
+        """Index all landmark and trader names of a navgraph"""
+        if not graph:
+            return cls()
+        landmarks = graph.get_vertices()[graph.vp.is_landmark.a.astype(bool)]
+        traders = graph.get_vertices()[graph.vp.is_trader.a.astype(bool)]
+        entries = [(graph.vp.landmark_name[vt], vt) for vt in landmarks]
+        entries += [(graph.vp.trader_name[vt], vt) for vt in traders]
+        return cls(entries)
+
+    def __len__(self):
+        return len(self.names)
+
+    def exact(self, name):
+        """Return all vertices carrying exactly this name"""
+        name = name.lower()
+        start = bisect_left(self.names, name)
+        end = bisect_right(self.names, name, lo=start)
+        return self.vertices[start:end]
+
+    def prefix(self, prefix, limit=None):
+        """Return the distinct names starting with prefix in alphabetical order"""
+        prefix = prefix.lower()
+        start = bisect_left(self.names, prefix)
+        end = bisect_left(self.names, prefix + '\U0010ffff', lo=start)
+        names = list(dict.fromkeys(self.names[start:end]))
+        return names[:limit] if limit else names
+
+    def fuzzy(self, name, max_dist=MAX_EDITS):
+        """Return the distinct names within max_dist (at most MAX_EDITS) edits of name, closest first"""
+        name = name.lower()
+        candidates = set()
+        for deletion in _deletions(name[:PREFIX], max_dist):
+            candidates.update(self.deletes.get(deletion, ()))
+        matches = []
+        for candidate in candidates:
+            dist = _edit_distance(name, candidate, max_dist)
+            if dist <= max_dist:
+                matches.append((dist, candidate))
+        return [candidate for _, candidate in sorted(matches)]
+
+    def complete(self, prefix):
+        """Return the longest completion of prefix shared by all names, and the candidates"""
+        candidates = self.prefix(prefix)
+        if not candidates:
+            return prefix, []
+        return commonprefix(candidates), candidates
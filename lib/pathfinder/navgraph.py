@@ -0,0 +1,324 @@
+"""
+Layout of the navgraph and coordinate access shared by importers and commanders.
+
+Positions are stored as two scalar int32 vertex properties *x* and *z*.
+Their `.a` attribute is a zero-copy numpy view, use that on hot paths instead of
+reading single vertices.
+"""
+import logging
+import os
+import uuid
+
+import graph_tool as gt
+import numpy as np
+
+from lib.pathfinder import journal
+
+
+def new_graph():
+    """Create an empty navgraph with all properties in place"""
+    graph = gt.Graph(directed=False)
+    graph.vp['is_tl'] = graph.new_vertex_property('bool', val=False)
+    graph.vp['x'] = graph.new_vertex_property('int32_t', val=0)
+    graph.vp['z'] = graph.new_vertex_property('int32_t', val=0)
+    graph.vp['elevation'] = graph.new_vertex_property('int', val=0)
+    graph.ep['weight'] = graph.new_edge_property('int', val=0)
+    graph.ep['is_tl'] = graph.new_edge_property('bool', val=False)
+    graph.ep['disabled'] = graph.new_edge_property('bool', val=False)  # e.g. broken translocators
+    graph.vp['is_trader'] = graph.new_vertex_property('bool', val=False)
+    graph.vp['trader_name'] = graph.new_vertex_property('string')
+    graph.vp['trader_type'] = graph.new_vertex_property('int', val=-1)
+    graph.vp['is_landmark'] = graph.new_vertex_property('bool', val=False)
+    graph.vp['landmark_name'] = graph.new_vertex_property('string')
+    graph.vp['landmark_type'] = graph.new_vertex_property('int')
+    graph.gp['journal_base'] = graph.new_graph_property('string', val='')  # Snapshot id, see journal
+    graph.gp['graph_id'] = graph.new_graph_property('string', val=uuid.uuid4().hex)  # Kept across snapshots
+    return graph
+
+
+def compact_graph(graph):
+    """Return a cleaned up copy of a navgraph
+
+    Vertices without any flag (left behind by queries of older versions) are dropped,
+    vertices sharing a position are merged into the first one keeping all flags and names,
+    and of parallel edges of the same kind only the cheapest is kept.
+    Vertices are numbered contiguously in their previous order.
+    """
+    vp = graph.vp
+    flags = vp.is_tl.a.astype(np.uint8) | vp.is_trader.a.astype(np.uint8) << 1 | vp.is_landmark.a.astype(np.uint8) << 2
+    kept = np.flatnonzero(flags)
+    _, first, inverse = np.unique(grid_cells(vp.x.a[kept], vp.z.a[kept], 1), return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    new_ids = np.full(graph.num_vertices(), -1, dtype=np.int64)
+    new_ids[kept] = rank[inverse.ravel()]
+    representative = kept[first[order]]
+    num_vertices = len(representative)
+
+    compacted = new_graph()
+    compacted.add_vertex(num_vertices)
+    merged = np.zeros(num_vertices, dtype=np.uint8)
+    np.bitwise_or.at(merged, new_ids[kept], flags[kept])
+    compacted.vp.is_tl.a = merged & 1
+    compacted.vp.is_trader.a = merged >> 1 & 1
+    compacted.vp.is_landmark.a = merged >> 2 & 1
+    for name in ('x', 'z', 'elevation'):
+        compacted.vp[name].a = vp[name].a[representative]
+    for name, flag in (('trader_type', vp.is_trader), ('landmark_type', vp.is_landmark)):
+        holders = kept[flag.a[kept].astype(bool)]
+        targets, first = np.unique(new_ids[holders], return_index=True)  # The first duplicate wins
+        values = compacted.vp[name].a.copy()  # Vertices without that flag keep the default
+        values[targets] = vp[name].a[holders[first]]
+        compacted.vp[name].a = values
+    for name, flag in (('trader_name', vp.is_trader), ('landmark_name', vp.is_landmark)):
+        for vt in kept[flag.a[kept].astype(bool)].tolist():
+            if vp[name][vt] and not compacted.vp[name][new_ids[vt]]:
+                compacted.vp[name][new_ids[vt]] = vp[name][vt]
+
+    edges = graph.get_edges([graph.ep.weight, graph.ep.is_tl, graph.ep.disabled])
+    u, v = new_ids[edges[:, 0]], new_ids[edges[:, 1]]
+    valid = (u >= 0) & (v >= 0) & (u != v)
+    lo, hi = np.minimum(u, v)[valid], np.maximum(u, v)[valid]
+    weight, is_tl, disabled = edges[valid, 2], edges[valid, 3], edges[valid, 4]
+    order = np.lexsort((weight, disabled, is_tl, hi, lo))  # Cheapest first within each kind of pair
+    keys = np.column_stack([lo, hi, is_tl, disabled])[order]
+    cheapest = order[np.concatenate([[True], np.any(keys[1:] != keys[:-1], axis=1)])] if len(order) else order
+    compacted.add_edge_list(np.column_stack([lo, hi, weight, is_tl, disabled])[np.sort(cheapest)],
+                            eprops=[compacted.ep.weight, compacted.ep.is_tl, compacted.ep.disabled])
+
+    for name, prop in graph.gp.items():
+        compacted.gp[name] = compacted.new_graph_property(prop.value_type(), val=prop[graph])
+    return compacted
+
+
+def upgrade_graph(graph):
+    """Bring a navgraph stored by an older version up to the current layout
+
+    Older graphs store positions in a *coord* vector<int> property
+    and lack the *disabled* edge property and the *journal_base* graph property.
+
+    :return bool: graph was modified
+    """
+    upgraded = False
+    if 'coord' in graph.vp:
+        logging.info("Migrating vertex coordinates to scalar x/z properties")
+        coords = graph.vp.coord.get_2d_array([0, 1])
+        graph.vp['x'] = graph.new_vertex_property('int32_t', vals=coords[0])
+        graph.vp['z'] = graph.new_vertex_property('int32_t', vals=coords[1])
+        del graph.vp['coord']
+        upgraded = True
+    if 'disabled' not in graph.ep:
+        graph.ep['disabled'] = graph.new_edge_property('bool', val=False)
+        upgraded = True
+    if 'journal_base' not in graph.gp:
+        graph.gp['journal_base'] = graph.new_graph_property('string', val='')
+        upgraded = True
+    if 'graph_id' not in graph.gp:
+        graph.gp['graph_id'] = graph.new_graph_property('string', val=uuid.uuid4().hex)
+        upgraded = True
+    return upgraded
+
+
+def load_graph(path):
+    """Load a navgraph snapshot from disk and replay its journal
+
+    The file is rewritten if it had to be upgraded or its journal was unusable.
+    """
+    graph = gt.load_graph(path)
+    upgraded = upgrade_graph(graph)
+    records, intact = journal.read(journal.journal_path(path), graph.gp.journal_base)
+    for record in records:
+        journal.apply(graph, record)
+    if records:
+        logging.info(f"Replayed {len(records)} journaled changes")
+    if upgraded or not intact:
+        save_graph(graph, path)
+    return graph
+
+
+def save_graph(graph, path):
+    """Save a full snapshot of the navgraph atomically and start an empty journal for it
+
+    The graph is written and synced to a temporary file first and renamed over path
+    afterwards, so a crash during saving never leaves a truncated navgraph behind.
+    A journal left over from the previous snapshot no longer matches its *journal_base*
+    and is ignored.
+    """
+    graph.gp.journal_base = uuid.uuid4().hex
+    tmp_path = path + '.tmp'
+    graph.save(tmp_path, fmt='gt')
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())  # The new journal is empty, the snapshot has to be on disk before it
+    os.replace(tmp_path, path)
+    journal.sync_directory(path)
+    journal.start(journal.journal_path(path), graph.gp.journal_base)
+
+
+def journal_change(graph, path, vertices, max_size):
+    """Persist an edit around vertices by appending to the journal of the snapshot at path
+
+    Falls back to a full snapshot if there is none yet or the journal outgrew max_size bytes.
+    """
+    log_path = journal.journal_path(path)
+    if not os.path.exists(path) or not os.path.exists(log_path) or os.path.getsize(log_path) > max_size:
+        save_graph(graph, path)
+        return
+    journal.append(log_path, journal.record(graph, vertices))
+
+
+def position(graph, vt):
+    """Return the (x, z) position of a single vertex as tuple"""
+    return int(graph.vp.x[vt]), int(graph.vp.z[vt])
+
+
+def find_vertices(graph, pos):
+    """Return the indices of all vertices located at pos"""
+    return np.flatnonzero((graph.vp.x.a == pos[0]) & (graph.vp.z.a == pos[1]))
+
+
+def distances(graph, pos, vertices):
+    """Return the manhattan distance from pos to each of the given vertex indices"""
+    return np.abs(graph.vp.x.a[vertices] - pos[0]) + np.abs(graph.vp.z.a[vertices] - pos[1])
+
+
+def _group(vertices, keys):
+    """Split vertices into a dict key -> vertex array"""
+    order = np.argsort(keys, kind='stable')
+    values, starts = np.unique(keys[order], return_index=True)
+    return dict(zip(values.tolist(), np.split(vertices[order], starts[1:])))
+
+
+class Categories:
+    """Vertex indices of TL, traders and landmarks, each also by type
+
+    Only valid for the graph state it was built from, use add for new vertices and
+    build a new one after changing flags. Everything else can share a single instance.
+    """
+
+    def __init__(self, graph=None):
+        empty = np.empty(0, dtype=np.int64)
+        if not graph:
+            self.tl = self.traders = self.landmarks = empty
+            self.traders_by_type, self.landmarks_by_type = {}, {}
+            return
+        vp = graph.vp
+        self.tl = np.flatnonzero(vp.is_tl.a)
+        self.traders = np.flatnonzero(vp.is_trader.a)
+        self.landmarks = np.flatnonzero(vp.is_landmark.a)
+        self.traders_by_type = _group(self.traders, vp.trader_type.a[self.traders])
+        self.landmarks_by_type = _group(self.landmarks, vp.landmark_type.a[self.landmarks])
+
+    def add(self, graph, vertices):
+        """Take the new vertices of graph into account"""
+        vertices = np.asarray(vertices, dtype=np.int64)
+        vp = graph.vp
+        traders = vertices[vp.is_trader.a[vertices] > 0]
+        landmarks = vertices[vp.is_landmark.a[vertices] > 0]
+        self.tl = np.append(self.tl, vertices[vp.is_tl.a[vertices] > 0])
+        self.traders = np.append(self.traders, traders)
+        self.landmarks = np.append(self.landmarks, landmarks)
+        for by_type, added in ((self.traders_by_type, _group(traders, vp.trader_type.a[traders])),
+                               (self.landmarks_by_type, _group(landmarks, vp.landmark_type.a[landmarks]))):
+            for kind, group in added.items():
+                by_type[kind] = np.append(by_type.get(kind, group[:0]), group)
+
+    def traders_of(self, trader_type):
+        return self.traders_by_type.get(trader_type, np.empty(0, dtype=np.int64))
+
+    def landmarks_of(self, landmark_type):
+        return self.landmarks_by_type.get(landmark_type, np.empty(0, dtype=np.int64))
+
+
+def grid_cells(x, z, cell_size):
+    """Return a single int64 key per position identifying its square grid cell"""
+    return (x // cell_size).astype(np.int64) * 2 ** 32 + (z // cell_size).astype(np.int64)
+
+
+class GridIndex:
+    """Static range index over positions, bucketed by square grid cells"""
+
+    def __init__(self, x, z, cell_size):
+        """
+        :param x: array of x positions
+        :param z: array of z positions
+        """
+        self.cell_size = cell_size
+        keys = grid_cells(x, z, cell_size)
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+        self.x = np.asarray(x, dtype=np.int64)[self.order]
+        self.z = np.asarray(z, dtype=np.int64)[self.order]
+        self._bucket()
+
+    def _bucket(self):
+        self.cell_keys, self.cell_start = np.unique(self.keys, return_index=True)
+        self.cell_end = np.append(self.cell_start[1:], len(self.keys)).astype(np.int64)
+
+    def insert(self, x, z):
+        """Add positions, they get the next indices after the existing ones"""
+        x, z = np.asarray(x, dtype=np.int64), np.asarray(z, dtype=np.int64)
+        keys = grid_cells(x, z, self.cell_size)
+        order = np.argsort(keys, kind='stable')
+        slots = np.searchsorted(self.keys, keys[order], side='right')
+        self.order = np.insert(self.order, slots, len(self.order) + order)
+        self.keys = np.insert(self.keys, slots, keys[order])
+        self.x = np.insert(self.x, slots, x[order])
+        self.z = np.insert(self.z, slots, z[order])
+        self._bucket()
+
+    def nearby(self, pos, radius):
+        """Return the indices of all positions within manhattan distance radius of pos, and their distances"""
+        empty = np.empty(0, dtype=np.int64)
+        if not len(self.order) or radius < 0:
+            return empty, empty
+        cx0, cz0 = (pos[0] - radius) // self.cell_size, (pos[1] - radius) // self.cell_size
+        cx1, cz1 = (pos[0] + radius) // self.cell_size, (pos[1] + radius) // self.cell_size
+        if (cx1 - cx0 + 1) * (cz1 - cz0 + 1) > len(self.cell_keys):
+            slots = np.arange(len(self.order))  # Cheaper to look at every position
+        else:
+            cx, cz = np.meshgrid(np.arange(cx0, cx1 + 1), np.arange(cz0, cz1 + 1))
+            keys = cx.ravel().astype(np.int64) * 2 ** 32 + cz.ravel()
+            cells = np.searchsorted(self.cell_keys, keys)
+            found = cells < len(self.cell_keys)
+            found[found] = self.cell_keys[cells[found]] == keys[found]
+            cells = cells[found]
+            if not cells.size:
+                return empty, empty
+            slots = np.concatenate([np.arange(a, b) for a, b in zip(self.cell_start[cells], self.cell_end[cells])])
+        dist = np.abs(self.x[slots] - pos[0]) + np.abs(self.z[slots] - pos[1])
+        in_range = dist <= radius
+        return self.order[slots[in_range]], dist[in_range]
+
+
+def mark_changed(graph, regions):
+    """Bump the graph version and log the regions touched by the change
+
+    Caches of derived data (e.g. map tiles) use the log to find out what to redo.
+
+    :param regions: boxes (xmin, zmin, xmax, zmax), all logged under the new version
+    """
+    if 'version' not in graph.gp:
+        graph.gp['version'] = graph.new_graph_property('int', val=0)
+        graph.gp['changes'] = graph.new_graph_property('vector<int>', val=[])
+    graph.gp.version += 1
+    regions = np.asarray(regions, dtype=np.int64).reshape(-1, 4)
+    rows = np.column_stack([np.full(len(regions), graph.gp.version), regions])
+    graph.gp.changes = list(graph.gp.changes) + rows.ravel().tolist()
+
+
+def graph_version(graph):
+    return graph.gp.version if 'version' in graph.gp else 0
+
+
+def change_log(graph):
+    """Return the change log as (N, 5) array of (version, xmin, zmin, xmax, zmax)"""
+    if 'changes' not in graph.gp:
+        return np.empty((0, 5), dtype=np.int64)
+    return np.array(graph.gp.changes, dtype=np.int64).reshape(-1, 5)
+
+
+def changes_since(graph, version):
+    """Return the regions (xmin, zmin, xmax, zmax) changed after version as (N, 4) array"""
+    log = change_log(graph)
+    return log[log[:, 0] > version, 1:]
@@ -0,0 +1,91 @@
+"""
+Columnar store of prospecting readings with a grid index for spatial queries.
+
+Each reading is a position plus one density (in per mille) per known ore.
+"""
+import logging
+import os
+
+import numpy as np
+
+from lib.pathfinder.navgraph import GridIndex
+
+CELL_SIZE = 256  # Edge length of a grid cell in blocks
+
+
+class OreIndex:
+
+    def __init__(self, ores=(), positions=None, densities=None):
+        """
+        :param ores: ore names, one per density column
+        :param positions: (N, 2) array of x, z
+        :param densities: (N, len(ores)) array of densities in per mille
+        """
+        self.ores = list(ores)
+        self.positions = np.empty((0, 2), dtype=np.int32) if positions is None else positions.astype(np.int32)
+        self.densities = np.empty((0, len(self.ores)), dtype=np.float32) if densities is None \
+            else densities.astype(np.float32)
+        self._build_grid()
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _build_grid(self):
+        self.grid = GridIndex(self.positions[:, 0], self.positions[:, 1], CELL_SIZE)
+
+    def add(self, ores, positions, densities):
+        """Merge new readings, a new reading replaces an older one at the same position
+
+        :param ores: ore names of the density columns
+        :param positions: (N, 2) array of x, z
+        :param densities: (N, len(ores)) array
+        """
+        for ore in ores:
+            if ore not in self.ores:
+                self.ores.append(ore)
+        columns = [self.ores.index(ore) for ore in ores]
+        new = np.zeros((len(positions), len(self.ores)), dtype=np.float32)
+        new[:, columns] = densities
+        old = np.zeros((len(self), len(self.ores)), dtype=np.float32)
+        old[:, :self.densities.shape[1]] = self.densities
+
+        all_positions = np.concatenate([self.positions, np.asarray(positions, dtype=np.int32)])
+        all_densities = np.concatenate([old, new])
+        # np.unique keeps the first occurrence, so look at the readings newest first
+        _, latest = np.unique(all_positions[::-1], axis=0, return_index=True)
+        keep = len(all_positions) - 1 - latest
+        self.positions = all_positions[keep]
+        self.densities = all_densities[keep]
+        self._build_grid()
+
+    def nearby(self, pos, radius):
+        """Return indices of all readings within manhattan distance radius of pos, and their distances"""
+        return self.grid.nearby(pos, radius)
+
+    def column(self, ore):
+        """Return the density column of an ore, None if unknown"""
+        try:
+            return self.densities[:, self.ores.index(ore)]
+        except ValueError:
+            return None
+
+    def save(self, path):
+        """Write the store atomically"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, ores=np.array(self.ores, dtype=str), positions=self.positions, densities=self.densities)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['ores'].tolist(), data['positions'], data['densities'])
+
+
+def load_ores(path):
+    """Load the ore store at path, empty if there is none yet"""
+    try:
+        return OreIndex.load(path)
+    except IOError:
+        logging.debug(f'No ore readings found at {path}')
+        return OreIndex()
@@ -0,0 +1,266 @@
+"""
+Multilevel overlay for routing on large navgraphs.
+
+The map is cut into square cells by position. Vertices with an edge leaving their
+cell are boundary vertices. For every cell the walking distances between its
+boundary vertices are precomputed as shortcuts ("customization").
+
+A query only expands vertices of the open cells with their real edges. Those are
+the cells of the endpoints and of every vertex the endpoints are attached to, so
+an endpoint close to a cell border may be linked to vertices across it. Every
+other cell is crossed via its shortcuts and the cut edges between cells, so the
+search space depends on the size of a cell and the number of boundary vertices
+rather than the whole map.
+Shortcuts on the final path are unpacked with a search inside their cell.
+
+Cells need to be much larger than the longest edge, otherwise nearly every
+vertex has an edge leaving its cell and there is nothing to skip.
+"""
+import copy
+import logging
+import time
+from heapq import heappush, heappop
+
+import numpy as np
+
+from lib.pathfinder.navgraph import grid_cells
+
+HASH_U = np.uint64(0x9E3779B97F4A7C15)
+HASH_V = np.uint64(0xC2B2AE3D27D4EB4F)
+HASH_W = np.uint64(0x165667B19E3779F9)
+
+
+def _csr(num_vertices, src, dst, *columns):
+    """Build undirected adjacency in CSR form
+
+    :return: indptr, neighbors, and every column reordered to match neighbors
+    """
+    source = np.concatenate([src, dst])
+    order = np.argsort(source, kind='stable')
+    indptr = np.searchsorted(source[order], np.arange(num_vertices + 1))
+    neighbors = np.concatenate([dst, src])[order]
+    return (indptr, neighbors) + tuple(np.concatenate([col, col])[order] for col in columns)
+
+
+class Overlay:
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.num_vertices = 0
+        self.shortcuts = {}  # cell -> {boundary vertex -> [(boundary vertex, dist)]}
+        self.fingerprints = {}  # cell -> hash over all edges touching the cell
+
+    def update(self, graph):
+        """Return an overlay for graph, re-customizing only the cells whose edges changed
+
+        The overlay itself is left untouched, so it can keep answering queries meanwhile.
+        """
+        starttime = time.time()
+        overlay = copy.copy(self)
+        overlay.shortcuts = dict(self.shortcuts)
+        overlay._load(graph)
+
+        fingerprints = {}
+        enabled = overlay.disabled_edges == 0
+        src, dst, weight = overlay.src[enabled], overlay.dst[enabled], overlay.weight[enabled]
+        if len(src):
+            h = src.astype(np.uint64) * HASH_U ^ dst.astype(np.uint64) * HASH_V ^ weight.astype(np.uint64) * HASH_W
+            keys, inverse = np.unique(np.concatenate([overlay.cell[src], overlay.cell[dst]]), return_inverse=True)
+            sums = np.zeros(len(keys), dtype=np.uint64)
+            np.add.at(sums, inverse, np.concatenate([h, h]))
+            fingerprints = dict(zip(keys.tolist(), sums.tolist()))
+        changed = [cell for cell, fp in fingerprints.items() if self.fingerprints.get(cell) != fp]
+        for cell in set(overlay.shortcuts) - set(fingerprints):
+            del overlay.shortcuts[cell]
+        overlay.fingerprints = fingerprints
+
+        for cell in changed:
+            overlay._customize(cell)
+        logging.info(f"overlay customized {len(changed)} of {len(fingerprints)} cells "
+                     f"in {time.time() - starttime:.2f} seconds")
+        return overlay
+
+    def _load(self, graph):
+        self.num_vertices = self.base_vertices = graph.num_vertices()
+        self.cell = grid_cells(graph.vp.x.a, graph.vp.z.a, self.cell_size)
+        self.cell_of = self.cell.tolist()
+        edges = graph.get_edges([graph.ep.weight, graph.ep.is_tl, graph.ep.disabled])
+        self.src, self.dst, self.weight = edges[:, 0], edges[:, 1], edges[:, 2]
+        self.disabled_edges = edges[:, 4]
+        # Disabled edges stay in the arrays, so toggling one is a flag change
+        self.indptr, self.neighbors, self.weights, self.is_tl, self.disabled = _csr(
+            self.num_vertices, self.src, self.dst, self.weight, edges[:, 3], edges[:, 4].astype(np.uint8))
+        cut = self.cell[self.src] != self.cell[self.dst]
+        self.cut_indptr, self.cut_neighbors, self.cut_weights, self.cut_is_tl, self.cut_disabled = _csr(
+            self.num_vertices, self.src[cut], self.dst[cut], self.weight[cut], edges[cut, 3],
+            edges[cut, 4].astype(np.uint8))
+        self.added = {}  # vertex -> [neighbor, weight, is_tl, disabled] of edges added since loading
+
+    def add(self, positions, edges):
+        """Add vertices and edges in place, re-customizing only the cells they touch
+
+        :param positions: (x, z) of vertices appended to the graph since the last update
+        :param edges: (u, v, weight, is_tl) of edges added since the last update
+        """
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 2)
+        cells = grid_cells(positions[:, 0], positions[:, 1], self.cell_size)
+        self.cell = np.append(self.cell, cells)
+        self.cell_of.extend(cells.tolist())
+        self.num_vertices += len(positions)
+        touched = set()
+        for u, v, w, is_tl in edges:
+            self.added.setdefault(u, []).append([v, w, is_tl, 0])
+            self.added.setdefault(v, []).append([u, w, is_tl, 0])
+            touched.update((self.cell_of[u], self.cell_of[v]))
+        for cell in touched:
+            self._customize(cell)
+
+    def set_disabled(self, u, v, disabled=True):
+        """Flip the disabled flag of the TL edges between u and v in place"""
+        for a, b in ((u, v), (v, u)):
+            for indptr, neighbors, is_tl, flags in ((self.indptr, self.neighbors, self.is_tl, self.disabled),
+                                                    (self.cut_indptr, self.cut_neighbors, self.cut_is_tl,
+                                                     self.cut_disabled)):
+                if a < self.base_vertices:
+                    lo, hi = indptr[a], indptr[a + 1]
+                    flags[lo + np.flatnonzero((neighbors[lo:hi] == b) & (is_tl[lo:hi] != 0))] = disabled
+            for hop in self.added.get(a, ()):
+                if hop[0] == b and hop[2]:
+                    hop[3] = int(disabled)
+        if self.cell_of[u] == self.cell_of[v]:  # Cut edges are not part of any shortcut
+            self._customize(self.cell_of[u])
+
+    def cell_at(self, pos):
+        """Return the cell containing a position"""
+        return int(grid_cells(np.array([pos[0]]), np.array([pos[1]]), self.cell_size)[0])
+
+    def boundary_fraction(self):
+        """Share of vertices with an edge leaving their cell"""
+        if not self.num_vertices:
+            return 0.0
+        return float(np.count_nonzero(self.cut_indptr[1:] > self.cut_indptr[:-1])) / self.base_vertices
+
+    def _edges(self, vt):
+        hops = []
+        if vt < self.base_vertices:
+            lo, hi = self.indptr[vt], self.indptr[vt + 1]
+            hops = [(nb, w, is_tl) for nb, w, is_tl, off in zip(
+                self.neighbors[lo:hi].tolist(), self.weights[lo:hi].tolist(), self.is_tl[lo:hi].tolist(),
+                self.disabled[lo:hi].tolist()) if not off]
+        hops += [(nb, w, is_tl) for nb, w, is_tl, off in self.added.get(vt, ()) if not off]
+        return hops
+
+    def _cut_edges(self, vt):
+        hops = []
+        if vt < self.base_vertices:
+            lo, hi = self.cut_indptr[vt], self.cut_indptr[vt + 1]
+            hops = [(nb, w, is_tl) for nb, w, is_tl, off in zip(
+                self.cut_neighbors[lo:hi].tolist(), self.cut_weights[lo:hi].tolist(),
+                self.cut_is_tl[lo:hi].tolist(), self.cut_disabled[lo:hi].tolist()) if not off]
+        cell = self.cell_of[vt]
+        hops += [(nb, w, is_tl) for nb, w, is_tl, off in self.added.get(vt, ())
+                 if not off and self.cell_of[nb] != cell]
+        return hops
+
+    def _boundary(self, cell):
+        """Return the vertices of cell with an edge into another cell"""
+        has_cut = self.cut_indptr[1:] > self.cut_indptr[:-1]
+        boundary = set(np.flatnonzero((self.cell[:self.base_vertices] == cell) & has_cut).tolist())
+        for vt, hops in self.added.items():
+            if self.cell_of[vt] == cell and any(self.cell_of[nb] != cell for nb, *_ in hops):
+                boundary.add(vt)
+        return sorted(boundary)
+
+    def _search_cell(self, cell, source, target=None):
+        """Dijkstra restricted to the vertices of one cell
+
+        :return: dist, pred dicts
+        """
+        cells = self.cell_of
+        dist = {source: 0}
+        pred = {}
+        heap = [(0, source)]
+        while heap:
+            d, vt = heappop(heap)
+            if vt == target:
+                break
+            if d > dist[vt]:
+                continue
+            for nb, w, is_tl in self._edges(vt):
+                if cells[nb] != cell:
+                    continue
+                if d + w < dist.get(nb, d + w + 1):
+                    dist[nb] = d + w
+                    pred[nb] = (vt, w, is_tl)
+                    heappush(heap, (d + w, nb))
+        return dist, pred
+
+    def _customize(self, cell):
+        boundary = self._boundary(cell)
+        shortcuts = {}
+        for vt in boundary:
+            dist, _ = self._search_cell(cell, vt)
+            shortcuts[vt] = [(other, dist[other]) for other in boundary if other != vt and other in dist]
+        self.shortcuts[cell] = shortcuts
+
+    def shortest_path(self, source, target, extra_edges=(), open_cells=()):
+        """Find the shortest path between two vertices
+
+        :param extra_edges: (u, v, weight) of edges added to the graph after the last update,
+                            e.g. those attaching query vertices. They must only lead into open cells.
+        :param open_cells: cells of the endpoints and of everything extra_edges lead to
+        :return: list of hops (u, v, weight, is_tl), None if target is unreachable
+        """
+        cells = self.cell_of
+        extra = {}
+        for u, v, w in extra_edges:
+            extra.setdefault(u, []).append((v, w, False))
+            extra.setdefault(v, []).append((u, w, False))
+        open_cells = set(open_cells) | {cells[vt] for vt in (source, target) if vt < self.num_vertices}
+
+        dist = {source: 0}
+        pred = {}  # vertex -> (previous vertex, weight, is_tl, shortcut cell or None)
+        heap = [(0, source)]
+        while heap:
+            d, vt = heappop(heap)
+            if vt == target:
+                break
+            if d > dist[vt]:
+                continue
+            hops = [(nb, w, is_tl, None) for nb, w, is_tl in extra.get(vt, ())]
+            if vt < self.num_vertices:
+                cell = cells[vt]
+                if cell in open_cells:
+                    hops += [(nb, w, is_tl, None) for nb, w, is_tl in self._edges(vt)]
+                else:
+                    hops += [(nb, w, False, cell) for nb, w in self.shortcuts.get(cell, {}).get(vt, ())]
+                    hops += [(nb, w, is_tl, None) for nb, w, is_tl in self._cut_edges(vt)]
+            for nb, w, is_tl, shortcut in hops:
+                if d + w < dist.get(nb, d + w + 1):
+                    dist[nb] = d + w
+                    pred[nb] = (vt, w, is_tl, shortcut)
+                    heappush(heap, (d + w, nb))
+
+        if target not in dist:
+            return None
+        path = []
+        vt = target
+        while vt != source:
+            prev, w, is_tl, shortcut = pred[vt]
+            if shortcut is None:
+                path.append((prev, vt, w, bool(is_tl)))
+            else:
+                path.extend(reversed(self._unpack(shortcut, prev, vt)))
+            vt = prev
+        return path[::-1]
+
+    def _unpack(self, cell, source, target):
+        """Expand a shortcut into the hops it stands for"""
+        _, pred = self._search_cell(cell, source, target)
+        hops = []
+        vt = target
+        while vt != source:
+            prev, w, is_tl = pred[vt]
+            hops.append((prev, vt, w, bool(is_tl)))
+            vt = prev
+        return hops[::-1]
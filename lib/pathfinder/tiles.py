@@ -0,0 +1,262 @@
+"""
+Render the navgraph as a pyramid of map tiles.
+
+Zoom level 0 is the coarsest, every level halves the blocks covered by a tile.
+Below DETAIL_ZOOM translocators and walking edges are aggregated into a density
+raster, from DETAIL_ZOOM on they are drawn individually.
+
+Tiles are cached as <tile_dir>/<zoom>/<tx>_<tz>.png together with a manifest of the
+graph version each tile was rendered at. A cached tile is redrawn only when a
+change logged in the graph after that version overlaps it, and deleted when
+nothing is left on it. The manifest also names the graph it was rendered from
+(its *graph_id* and a checksum of its change log), any other graph starts over.
+"""
+import json
+import zlib
+import logging
+import os
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+import numpy as np
+
+from lib.pathfinder.navgraph import graph_version, changes_since, change_log, grid_cells
+from lib.pathfinder.util import trader_colors
+
+TILE_PIXELS = 256
+MAX_ZOOM = 6
+DETAIL_ZOOM = 3
+BLOCKS_PER_PIXEL = 2  # At MAX_ZOOM
+
+TL_COLOR = '#a000a0'
+WALK_COLOR = '#909090'
+LANDMARK_COLOR = '#000000'
+ROUTE_COLOR = '#ff0000'
+
+
+def tile_blocks(zoom):
+    """Edge length of a tile in blocks"""
+    return TILE_PIXELS * BLOCKS_PER_PIXEL * 2 ** (MAX_ZOOM - zoom)
+
+
+def walk_segments(graph):
+    """Return all walking edges as (N, 2, 2) array of line segments"""
+    x, z = graph.vp.x.a, graph.vp.z.a
+    edges = graph.get_edges([graph.ep.is_tl])
+    walks = edges[edges[:, 2] == 0]
+    return np.stack([np.column_stack([x[walks[:, 0]], z[walks[:, 0]]]),
+                     np.column_stack([x[walks[:, 1]], z[walks[:, 1]]])], axis=1)
+
+
+def segment_tiles(segments, size):
+    """Return (segment index, tx, tz) of every tile of edge length size a segment passes through"""
+    segments = segments.astype(np.float64)
+    start, end = segments[:, 0], segments[:, 1]
+    flip = start[:, 0] > end[:, 0]  # Walk every segment towards +x
+    start[flip], end[flip] = end[flip], start[flip].copy()
+    tx0, tx1 = np.floor_divide(start[:, 0], size), np.floor_divide(end[:, 0], size)
+    # One row per segment and tile column it touches
+    columns = (tx1 - tx0 + 1).astype(np.int64)
+    idx = np.repeat(np.arange(len(segments)), columns)
+    tx = tx0[idx] + np.arange(columns.sum()) - np.repeat(np.cumsum(columns) - columns, columns)
+    xa, za, xb, zb = start[idx, 0], start[idx, 1], end[idx, 0], end[idx, 1]
+    left, right = np.maximum(xa, tx * size), np.minimum(xb, (tx + 1) * size)
+    dx = xb - xa
+    slope = np.divide(zb - za, dx, out=np.zeros_like(dx), where=dx != 0)
+    z_left = np.where(dx != 0, za + (left - xa) * slope, za)
+    z_right = np.where(dx != 0, za + (right - xa) * slope, zb)
+    tz0 = np.floor_divide(np.minimum(z_left, z_right), size)
+    tz1 = np.floor_divide(np.maximum(z_left, z_right), size)
+    # Expand again into one row per tile in that column
+    rows = (tz1 - tz0 + 1).astype(np.int64)
+    tiles_idx = np.repeat(idx, rows)
+    tiles_tx = np.repeat(tx, rows)
+    tiles_tz = np.repeat(tz0, rows) + np.arange(rows.sum()) - np.repeat(np.cumsum(rows) - rows, rows)
+    return tiles_idx, tiles_tx.astype(np.int64), tiles_tz.astype(np.int64)
+
+
+def _slices(keys):
+    """Sort keys and return the order along with a dict key -> slice of that order"""
+    order = np.argsort(keys, kind='stable')
+    unique, start = np.unique(keys[order], return_index=True)
+    end = np.append(start[1:], len(keys))
+    return order, {key: slice(a, b) for key, a, b in zip(unique.tolist(), start.tolist(), end.tolist())}
+
+
+def _checksum(log):
+    return zlib.crc32(np.ascontiguousarray(log, dtype=np.int64).tobytes())
+
+
+class TileRenderer:
+
+    def __init__(self, tile_dir):
+        self.tile_dir = tile_dir
+        self.manifest_path = os.path.join(tile_dir, 'manifest.json')
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            self.source, self.manifest = manifest['graph'], manifest['tiles']
+        except (IOError, ValueError, KeyError, TypeError):
+            self.source, self.manifest = None, {}
+        self.figure = Figure(figsize=(1, 1), dpi=TILE_PIXELS)
+        FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_axes([0, 0, 1, 1])
+
+    def render(self, graph, zooms=range(MAX_ZOOM + 1)):
+        """Render all tiles of the given zoom levels that are missing or outdated
+
+        Vertices and walking edges are bucketed by tile once per zoom level,
+        so drawing a tile only looks at what lies on it.
+
+        :return: number of rendered tiles
+        """
+        if not graph or not graph.num_vertices():
+            return 0
+        self._check_source(graph)
+        x, z = graph.vp.x.a.astype(np.int64), graph.vp.z.a.astype(np.int64)
+        segments = walk_segments(graph)
+        version = graph_version(graph)
+
+        rendered = 0
+        for zoom in zooms:
+            size = tile_blocks(zoom)
+            vertex_order, vertex_tiles = _slices(grid_cells(x, z, size))
+            if zoom >= DETAIL_ZOOM:
+                seg_idx, seg_tx, seg_tz = segment_tiles(segments, size)
+                seg_keys = seg_tx * 2 ** 32 + seg_tz
+            else:
+                seg_idx, seg_keys = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+            segment_order, segment_tiles_ = _slices(seg_keys)
+            empty = slice(0, 0)
+            keys = set(vertex_tiles) | set(segment_tiles_)
+            removed = 0
+            for tile in [tile for tile in self.manifest if tile.startswith(f"{zoom}/")]:
+                tx, tz = map(int, tile[len(f"{zoom}/"):].split('_'))
+                if tx * 2 ** 32 + tz not in keys and self._outdated(graph, tile, (tx * size, tz * size, size)):
+                    self._remove(tile)  # Everything that was on it is gone
+                    removed += 1
+            if removed:
+                logging.info(f"removed {removed} empty tiles of zoom level {zoom}")
+            for key in sorted(keys):
+                tz = (key + 2 ** 31) % 2 ** 32 - 2 ** 31  # Inverse of grid_cells
+                tx = (key - tz) // 2 ** 32
+                tile = f"{zoom}/{tx}_{tz}"
+                path = os.path.join(self.tile_dir, f"{tile}.png")
+                if os.path.exists(path) and not self._outdated(graph, tile, (tx * size, tz * size, size)):
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                vertices = vertex_order[vertex_tiles.get(key, empty)]
+                on_tile = segments[seg_idx[segment_order[segment_tiles_.get(key, empty)]]]
+                self._draw(graph, on_tile, vertices, zoom, tx * size, tz * size, size)
+                self.figure.savefig(path, dpi=TILE_PIXELS)
+                self.manifest[tile] = version
+                rendered += 1
+        self._save_manifest()
+        logging.info(f"rendered {rendered} tiles to {self.tile_dir}")
+        return rendered
+
+    def render_route(self, graph, steps, path, margin=500):
+        """Render a single image of the area around a route with the route on top
+
+        :param steps: route as returned by GraphCommander.find_path
+        """
+        if not steps:
+            return
+        points = np.array([step[0] for step in steps] + [steps[-1][1]])
+        x0, z0 = points.min(axis=0) - margin
+        x1, z1 = points.max(axis=0) + margin
+        size = max(x1 - x0, z1 - z0)
+        zoom = int(np.clip(MAX_ZOOM - np.ceil(np.log2(max(size / tile_blocks(MAX_ZOOM), 1))), DETAIL_ZOOM, MAX_ZOOM))
+        segments = walk_segments(graph)
+        lo, hi = segments.min(axis=1), segments.max(axis=1)
+        visible = (lo[:, 0] < x0 + size) & (hi[:, 0] >= x0) & (lo[:, 1] < z0 + size) & (hi[:, 1] >= z0)
+        x, z = graph.vp.x.a, graph.vp.z.a
+        inside = np.flatnonzero((x >= x0) & (x < x0 + size) & (z >= z0) & (z < z0 + size))
+        self._draw(graph, segments[visible], inside, zoom, x0, z0, size)
+        walked = [(a, b) for a, b, _, is_tl in steps if not is_tl]
+        jumps = [(a, b) for a, b, _, is_tl in steps if is_tl]
+        self.axes.add_collection(LineCollection(walked, colors=ROUTE_COLOR, linewidths=1.5))
+        self.axes.add_collection(LineCollection(jumps, colors=ROUTE_COLOR, linewidths=0.8, linestyles='dotted'))
+        self.figure.savefig(path, dpi=TILE_PIXELS * 2)
+        logging.info(f"rendered route to {path}")
+
+    def _check_source(self, graph):
+        """Drop all cached tiles unless they were rendered from an earlier state of graph"""
+        log = change_log(graph)
+        source = self.source or {}
+        seen = source.get('log_length', 0)
+        same = (source.get('graph_id') == graph.gp.graph_id and seen <= len(log)
+                and source.get('checksum') == _checksum(log[:seen]))
+        if not same:
+            self._clear()
+        self.source = {'graph_id': graph.gp.graph_id, 'log_length': len(log), 'checksum': _checksum(log)}
+
+    def _clear(self):
+        """Delete every cached tile, including those of manifests this renderer could not read"""
+        removed = 0
+        for zoom in range(MAX_ZOOM + 1):
+            directory = os.path.join(self.tile_dir, str(zoom))
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.endswith('.png'):
+                    os.remove(os.path.join(directory, name))
+                    removed += 1
+        if removed:
+            logging.info(f"tiles in {self.tile_dir} were rendered from another graph, removed {removed} of them")
+        self.manifest = {}
+
+    def _remove(self, tile):
+        try:
+            os.remove(os.path.join(self.tile_dir, f"{tile}.png"))
+        except FileNotFoundError:
+            pass
+        del self.manifest[tile]
+
+    def _outdated(self, graph, key, bounds):
+        if key not in self.manifest:
+            return True
+        x0, z0, size = bounds
+        changes = changes_since(graph, self.manifest[key])
+        return bool(np.any((changes[:, 0] < x0 + size) & (changes[:, 2] >= x0) &
+                           (changes[:, 1] < z0 + size) & (changes[:, 3] >= z0)))
+
+    def _draw(self, graph, segments, vertices, zoom, x0, z0, size):
+        """Draw the square area starting at x0, z0 onto the axes
+
+        :param segments: walking edges crossing the area
+        :param vertices: indices of the vertices inside the area
+        """
+        ax = self.axes
+        ax.cla()
+        ax.set_axis_off()
+        ax.set_xlim(x0, x0 + size)
+        ax.set_ylim(z0 + size, z0)  # North is -z
+        x, z = graph.vp.x.a[vertices], graph.vp.z.a[vertices]
+        tl = graph.vp.is_tl.a[vertices].astype(bool)
+
+        if zoom < DETAIL_ZOOM:
+            density, _, _ = np.histogram2d(x[tl], z[tl], bins=TILE_PIXELS // 4,
+                                           range=[[x0, x0 + size], [z0, z0 + size]])
+            ax.imshow(np.log1p(density.T), extent=(x0, x0 + size, z0 + size, z0),
+                      cmap='Purples', interpolation='nearest', vmin=0, zorder=1)
+        else:
+            ax.add_collection(LineCollection(segments, colors=WALK_COLOR, linewidths=0.2, zorder=1))
+            ax.scatter(x[tl], z[tl], s=1, c=TL_COLOR, marker='o', linewidths=0, zorder=2)
+
+        traders = graph.vp.is_trader.a[vertices].astype(bool)
+        trader_types = graph.vp.trader_type.a[vertices][traders]
+        colors = [trader_colors.get(t, trader_colors[0]) for t in trader_types.tolist()]
+        ax.scatter(x[traders], z[traders], s=4, c=colors, marker='s', linewidths=0, zorder=3)
+        landmarks = graph.vp.is_landmark.a[vertices].astype(bool)
+        ax.scatter(x[landmarks], z[landmarks], s=6, c=LANDMARK_COLOR, marker='*', linewidths=0, zorder=3)
+
+    def _save_manifest(self):
+        os.makedirs(self.tile_dir, exist_ok=True)
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'graph': self.source, 'tiles': self.manifest}, f)
+        os.replace(tmp_path, self.manifest_path)
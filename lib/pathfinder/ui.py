@@ -5,12 +5,17 @@ from lib.pathfinder.commander import MasterCommander
 import logging
 from logging import Handler
 import sys
+import threading
 
 class Prompt(Input):
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, completer=None, **kwargs):
+        """
+        :param completer: callable returning (completion, candidates) for a prefix
+        """
         self.history = []
         self.history_marker = -1
+        self.completer = completer
         return super().__init__(*args, **kwargs)
 
     class Submitted(Message):
@@ -36,6 +41,23 @@ class Prompt(Input):
             if self.history_marker < -1:
                 self.history_marker += 1
                 self.value = self.history[self.history_marker]
+        if event.key == 'tab':
+            event.prevent_default()
+            event.stop()
+            self.complete()
+
+    def complete(self):
+        """Complete the last argument to a known location name"""
+        command, space, prefix = self.value.rpartition(' ')
+        if not self.completer or not space:
+            return  # Only arguments are completed
+        completion, candidates = self.completer(prefix)
+        if len(candidates) == 1:
+            completion += ' '
+        elif len(candidates) > 1:
+            logging.info(' '.join(candidates[:20]))
+        self.value = command + space + completion
+        self.cursor_position = len(self.value)
 
 
 
@@ -56,7 +78,10 @@ class TerminalHandler(Handler):
         }
         log_msg = style[record.levelno]
         log_msg += record.msg + "[/]"
-        self.terminal.write(log_msg)
+        if threading.current_thread() is threading.main_thread():
+            self.terminal.write(log_msg)
+        else:
+            self.terminal.app.call_from_thread(self.terminal.write, log_msg)  # e.g. background imports
 
 
 class Terminal(TextLog):
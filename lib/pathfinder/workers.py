@@ -0,0 +1,84 @@
+"""
+Pool of worker processes answering route queries from a shared CSR export.
+
+Workers only memory map the export written by CSRGraph.export, so starting one
+parses nothing and all of them share the same pages of the navgraph. They never
+import graph_tool.
+
+The pool lives as long as the app. Workers check the export before every query
+and map it again when it was replaced or got vertices added, flipped edge flags
+they see without doing anything.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from lib.pathfinder.csr import CSRGraph
+
+_directory = None
+_graph = None  # The export mapped by this worker process
+_stamp = None  # CSRGraph.stamp of _graph
+
+
+def _attach(directory):
+    global _directory
+    _directory = directory
+
+
+def _current_graph():
+    global _graph, _stamp
+    for _ in range(3):  # The export may get replaced between reading the stamp and opening it
+        stamp = CSRGraph.stamp(_directory)
+        if stamp == _stamp:
+            break
+        try:
+            _graph, _stamp = CSRGraph.open(_directory), stamp
+        except FileNotFoundError:
+            continue
+    return _graph
+
+
+def _route(stops):
+    return _current_graph().route(stops)
+
+
+def _closest_traders(origin, trader_type, maxdist, link_dist_tl):
+    return _current_graph().closest_traders(origin, trader_type, maxdist, link_dist_tl)
+
+
+class RoutePool:
+
+    def __init__(self, directory, processes=None):
+        """
+        :param directory: CSR export directory, see CSRGraph.export
+        :param processes: number of workers, one per core by default
+        """
+        # spawn instead of fork, a fork would inherit the full graph_tool graph of the parent.
+        # Spawned workers import the main module again, see vspath.py
+        self.pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=_attach, initargs=(directory,))
+
+    def route(self, stops):
+        """Same as CSRGraph.route, run by a worker
+
+        :return: Future of the list of legs
+        """
+        return self.pool.submit(_route, stops)
+
+    def routes(self, queries):
+        """Answer many route queries in parallel
+
+        :param queries: iterable of stop lists
+        :return: list of legs per query, in order
+        """
+        return list(self.pool.map(_route, queries))
+
+    def closest_traders(self, origin, trader_type=None, maxdist=500, link_dist_tl=None):
+        """Same as CSRGraph.closest_traders, run by a worker
+
+        :return: Future of the list of (trader vertex, dist)
+        """
+        return self.pool.submit(_closest_traders, origin, trader_type, maxdist, link_dist_tl)
+
+    def close(self, wait=False):
+        """Let the workers finish their queries and exit"""
+        self.pool.shutdown(wait=wait)
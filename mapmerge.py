@@ -4,14 +4,142 @@
 import argparse
 import json
 import logging
+import os
+import textwrap
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from itertools import repeat
 
-from lib.pathfinder.util import get_trader_type, trader_colors, trader_descriptions, manhattan
+import numpy as np
+
+from lib.pathfinder.util import get_trader_type, trader_colors, trader_descriptions
 
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger()
 
-known_features = {}  # (x,z) key -> feature_spec
+DOUBLET_DIST = 10  # Features of the same kind closer than this are considered the same
+
+
+def _cell_keys(positions):
+    """Return a single int64 key per (x, z) identifying its DOUBLET_DIST cell"""
+    cells = np.asarray(positions, dtype=np.int64).reshape(-1, 2) // DOUBLET_DIST
+    return cells[:, 0] * 2 ** 32 + cells[:, 1]
+
+
+class FeatureIndex:
+    """Position, icon and trader type of every merged feature
+
+    Features are bucketed into cells of DOUBLET_DIST blocks, so a doublet can only
+    be found in the 3x3 cells around a position. Trader types are derived from the
+    title once when a feature is added.
+
+    Features of earlier runs stay in the arrays they were loaded from, sorted by
+    cell, and are searched with numpy. Only features added in this run are kept in
+    python, so loading an index costs nothing per feature.
+    """
+
+    def __init__(self, positions=None, icons=None, trader_types=None, keys=None, order=None):
+        """
+        :param keys: sorted cell keys of the loaded features, see _cell_keys
+        :param order: feature index for each entry of keys
+        """
+        self.base_positions = np.empty((0, 2), dtype=np.int64) if positions is None else positions
+        self.base_icons = np.empty(0, dtype=str) if icons is None else icons
+        self.base_trader_types = np.empty(0, dtype=np.int8) if trader_types is None else trader_types
+        self.base_keys = np.empty(0, dtype=np.int64) if keys is None else keys
+        self.base_order = np.empty(0, dtype=np.int64) if order is None else order
+        self.positions = []  # Features added since loading
+        self.icons = []
+        self.trader_types = []
+        self.exact = set()
+        self.cells = {}  # (cx, cz) -> indices
+
+    def __len__(self):
+        return len(self.base_positions) + len(self.positions)
+
+    def __contains__(self, pos):
+        if pos in self.exact:
+            return True
+        found = self._base_in_cells(pos, (0,))
+        return bool((self.base_positions[found] == pos).all(axis=1).any())
+
+    def position(self, i):
+        if i < len(self.base_positions):
+            return tuple(self.base_positions[i].tolist())
+        return self.positions[i - len(self.base_positions)]
+
+    def add(self, pos, icon, trader_type):
+        cell = (pos[0] // DOUBLET_DIST, pos[1] // DOUBLET_DIST)
+        self.cells.setdefault(cell, []).append(len(self))
+        self.positions.append(pos)
+        self.icons.append(icon)
+        self.trader_types.append(trader_type)
+        self.exact.add(pos)
+
+    def _base_in_cells(self, pos, offsets):
+        """Return the loaded features in the cells around pos, offsets apply to both axes"""
+        cx, cz = pos[0] // DOUBLET_DIST, pos[1] // DOUBLET_DIST
+        keys = [(cx + dx) * 2 ** 32 + cz + dz for dx in offsets for dz in offsets]
+        starts = np.searchsorted(self.base_keys, keys, side='left')
+        ends = np.searchsorted(self.base_keys, keys, side='right')
+        return np.concatenate([self.base_order[a:b] for a, b in zip(starts, ends)])
+
+    def find_doublet(self, pos, icon, trader_type):
+        """Return the index of a feature of the same kind close to pos, None if there is none"""
+        found = self._base_in_cells(pos, (-1, 0, 1))
+        close = np.abs(self.base_positions[found] - pos).sum(axis=1) < DOUBLET_DIST
+        same = close & (self.base_icons[found] == icon) & (self.base_trader_types[found] == trader_type)
+        if same.any():
+            return int(found[np.argmax(same)])
+        cx, cz = pos[0] // DOUBLET_DIST, pos[1] // DOUBLET_DIST
+        for dx in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                for i in self.cells.get((cx + dx, cz + dz), ()):
+                    other = self.position(i)
+                    j = i - len(self.base_positions)
+                    if abs(other[0] - pos[0]) + abs(other[1] - pos[1]) < DOUBLET_DIST \
+                            and self.icons[j] == icon and self.trader_types[j] == trader_type:
+                        return i
+        return None
+
+    def save(self, path, tail_offset, size):
+        """Write the index atomically along with where to append to the export it describes
+
+        :param tail_offset: byte offset in the export just behind the last waypoint
+        :param size: size of the export in bytes
+        """
+        positions = np.concatenate([self.base_positions, np.array(self.positions, dtype=np.int64).reshape(-1, 2)])
+        keys = _cell_keys(positions)
+        order = np.argsort(keys, kind='stable')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, positions=positions,
+                     icons=np.concatenate([self.base_icons, np.array(self.icons, dtype=str)]),
+                     trader_types=np.concatenate([self.base_trader_types,
+                                                  np.array(self.trader_types, dtype=np.int8)]),
+                     keys=keys[order], order=order, tail_offset=tail_offset, size=size)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """:return: index, tail_offset, size"""
+        with np.load(path) as data:
+            if 'keys' in data.files:
+                keys, order = data['keys'], data['order']
+            else:  # Written before the keys were stored
+                keys = _cell_keys(data['positions'])
+                order = np.argsort(keys, kind='stable')
+                keys = keys[order]
+            index = cls(data['positions'], data['icons'], data['trader_types'], keys, order)
+            return index, int(data['tail_offset']), int(data['size'])
+
+
+def index_path(output):
+    """Location of the sidecar index of an export"""
+    return output + '.index.npz'
+
+
+known_features = FeatureIndex()
 doublets = 0
 
 
@@ -22,31 +150,133 @@ def is_doubled(pos, feature):
     :return bool: Is feature double?
     """
     global doublets
-    server_icon = feature["ServerIcon"]
-    trader_type = get_trader_type(feature['Title'])
-    for key in known_features:
-        if manhattan(key, pos) < 10:
-            item = known_features[key]
-            if item['ServerIcon'] == server_icon and trader_type == get_trader_type(item['Title']):
-                log.debug(f"Considered doublet: {feature['Title']} {pos} =~ {key} {item['Title']}")
+    i = known_features.find_doublet(pos, feature["ServerIcon"], get_trader_type(feature['Title']))
+    if i is None:
+        return False
+    log.debug(f"Considered doublet: {feature['Title']} {pos} =~ {known_features.position(i)}")
+    doublets += 1
+    return True
+
+
+def merge_features(candidates, map_features):
+    """Attach parsed features to map_features unless they are doublets
+
+    Must be called once per input file in order of decreasing preference,
+    the first feature for any given map-position wins.
+
+    :param candidates: list of (pos, spec, exact) as returned by parse_file
+    :param list map_features: existing features
+    :return: map_features
+    """
+    global doublets
+    for pos, spec, exact in candidates:
+        if exact:
+            if pos in known_features:
+                log.debug(f"Coordinate {pos} already has a feature")
                 doublets += 1
-                return True
-    return False
+                continue
+        elif is_doubled(pos, spec):
+            continue
+        map_features.append(spec)
+        known_features.add(pos, spec['ServerIcon'], get_trader_type(spec['Title']))
+    return map_features
+
+
+def _waypoints(features, first):
+    """Serialize waypoints like json.dump(indent=4) would inside the export
+
+    :param first: features start the list, no separator in front
+    """
+    parts = []
+    for spec in features:
+        parts.append(('\n' if first else ',\n') + textwrap.indent(json.dumps(spec, indent=4), ' ' * 8))
+        first = False
+    return ''.join(parts).encode()
+
+
+def _tail(count):
+    return (f'\n    ],\n    "Count": {count},\n'
+            f'    "DateCreated": {json.dumps(datetime.utcnow().isoformat())}\n}}').encode()
+
+
+def write_export(filename, worldname, features):
+    """Write a complete CC export
 
+    Waypoints come before Count and DateCreated, so new ones can be appended later
+    by rewriting only what follows the last one.
 
-def process_translocator(indata, waypoints, offset):
-    """Add single translocator in webmap-format to waypoints
+    :return: tail_offset, size
+    """
+    with open(filename, 'wb') as f:
+        f.write(f'{{\n    "Name": "Webmap Waypoints",\n    "World": {json.dumps(worldname)},\n'
+                f'    "Waypoints": ['.encode())
+        f.write(_waypoints(features, first=True))
+        tail_offset = f.tell()
+        f.write(_tail(len(features)))
+        return tail_offset, f.tell()
+
+
+def tail_backup_path(filename):
+    """Location of the copy of the tail an append is about to overwrite"""
+    return filename + '.tail'
+
+
+def append_export(filename, tail_offset, count, features):
+    """Append features to an export written by write_export
+
+    The tail that gets overwritten is saved to tail_backup_path first. It stays
+    until the caller removed it, after saving whatever refers to the new export.
+    Should anything fail in between, restore_export undoes the append.
+
+    :param count: number of waypoints already in the export
+    :return: tail_offset, size
+    """
+    backup = tail_backup_path(filename)
+    with open(filename, 'rb') as f:
+        f.seek(tail_offset)
+        tail = f.read()
+    with open(backup + '.tmp', 'wb') as f:
+        f.write(f'{tail_offset}\n'.encode() + tail)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(backup + '.tmp', backup)
+    with open(filename, 'r+b') as f:
+        f.seek(tail_offset)
+        f.write(_waypoints(features, first=not count))
+        tail_offset = f.tell()
+        f.write(_tail(count + len(features)))
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+        return tail_offset, f.tell()
+
+
+def restore_export(filename):
+    """Put back the tail saved by an unfinished append_export and drop the backup"""
+    backup = tail_backup_path(filename)
+    with open(backup, 'rb') as f:
+        tail_offset = int(f.readline())
+        tail = f.read()
+    with open(filename, 'r+b') as f:
+        f.seek(tail_offset)
+        f.write(tail)
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+    os.remove(backup)
+
+
+def process_translocator(indata, offset):
+    """Convert single translocator in webmap-format to CC-Format
+
+    Translocators only count as doublets when sharing the exact position.
 
     :param indata:
-    :param waypoints:
     :param tuple offset: Worldspawn in absolute coordinates
-    :return: waypoints
+    :return: list of (pos, spec, exact)
     """
-    global known_features
 
     def tl_spec(tl, depth):
-        nonlocal offset
-        global doublets
         spec = {
             "Title": f"Translocator to ({tl[0]}, {depth}, {-tl[1]})",
             "DetailText": None,
@@ -58,36 +288,20 @@ def process_translocator(indata, waypoints, offset):
             "Selected": True
         }
         pos = (spec['Position']['X'], spec['Position']['Z'])
-        if pos in known_features:
-            log.debug(f"Coordinate {pos} already has a feature")
-            doublets += 1
-            return False
-        known_features[pos] = spec
-        return spec
+        return pos, spec, True
 
     d1, d2 = indata['properties']['depth1'], indata['properties']['depth2']
     tl1, tl2 = indata['geometry']['coordinates']
+    return [tl_spec(tl1, d1), tl_spec(tl2, d2)]
 
-    tl1_spec = tl_spec(tl1, d1)
-    tl2_spec = tl_spec(tl2, d2)
-
-    if tl1_spec:
-        waypoints.append(tl1_spec)
-    if tl2_spec:
-        waypoints.append(tl2_spec)
-    return waypoints
 
-
-def process_trader(indata, waypoints, offset):
-    """Add single Trader in webmap-format to waypoints
+def process_trader(indata, offset):
+    """Convert single Trader in webmap-format to CC-Format
 
     :param indata:
-    :param waypoints:
     :param tuple offset: Worldspawn in absolute coordinates
-    :return: waypoints
+    :return: list of (pos, spec, exact)
     """
-    global known_features
-    global doublets
     spec = {
         "Title": "Unknown Trader",
         "DetailText": None,
@@ -108,32 +322,27 @@ def process_trader(indata, waypoints, offset):
     spec['Position']['Y'] = indata['properties']['z']  # Webmap calls the vs-Y "z"
     z = spec['Position']['Z'] = -indata['geometry']['coordinates'][1] + offset[1]  # Webmap has Z * -1 for "reasons"
 
-    if not is_doubled((x, z), spec):
-        waypoints.append(spec)
-        known_features[(x, z)] = spec
+    return [((x, z), spec, False)]
 
-    return waypoints
 
-
-def process_landmark(indata, outdata, offset):
+def process_landmark(indata, offset):
     raise NotImplementedError
 
 
-def process_base(indata, outdata, offset):
+def process_base(indata, offset):
     raise NotImplementedError
 
 
-def process_geojson(filename, map_features=[], no_traders=False, no_tls=False):
+def process_geojson(filename, offset, no_traders=False, no_tls=False):
     """
     The webmap uses a geojson file for each type of feature.
-    Figure out the type, convert coordinates to absolute and
-    attach the features to the featurelist.
+    Figure out the type and convert coordinates to absolute.
 
     :param filename: path to geojson
-    :param map_features: List of Features
+    :param tuple offset: Worldspawn in absolute coordinates
     :param bool no_traders: Ignore Waypoints with Trader-Icon
     :param bool no_tls: Ignore Waypoints with Spiral-Icon
-    :return: map_features
+    :return: list of (pos, spec, exact)
     """
     with open(filename) as f:
         data = json.load(f)
@@ -141,36 +350,35 @@ def process_geojson(filename, map_features=[], no_traders=False, no_tls=False):
     if data['name'] == 'translocators':
         if no_tls:
             logging.warning(f"--notls was set but {filename} only contains TL's! (ignoring file)")
-            return map_features
+            return []
         process = process_translocator
     elif data['name'] == 'traders':
         if no_traders:
             logging.warning(f"--notraders was set but {filename} only contains Traders! (ignoring file)")
-            return map_features
+            return []
         process = process_trader
     elif data['name'] == 'landmarks':
         process = process_landmark
     elif data['name'] == 'players_bases':
         process = process_base
 
+    candidates = []
     for item in data['features']:
-        process(item, map_features, offset)
+        candidates.extend(process(item, offset))
 
-    return map_features
+    return candidates
 
 
-def process_cc_json(filename, map_features, no_traders=False, no_tls=False):
-    """Attach features from a CampaignCartographer file
+def process_cc_json(filename, no_traders=False, no_tls=False):
+    """Read features from a CampaignCartographer file
     Apply filters, but leave entries otherwise unmodified.
 
     :param filename: path to the export.json
-    :param list map_features: existing features
     :param bool no_traders: Ignore trader-icons
     :param no_tls:  Ignore spiral-icons
-    :return: map_features
+    :return: list of (pos, spec, exact)
     """
-    global known_features
-    global doublets
+    candidates = []
     with open(filename) as f:
         data = json.load(f)
         for item in data['Waypoints']:
@@ -180,17 +388,28 @@ def process_cc_json(filename, map_features, no_traders=False, no_tls=False):
                 continue
             if no_tls and item['ServerIcon'] == 'spiral':
                 continue
-            if not is_doubled(pos, item):
-                map_features.append(item)
-                known_features[pos] = item
+            candidates.append((pos, item, False))
 
-    return map_features
+    return candidates
+
+
+def parse_file(filename, offset, no_traders=False, no_tls=False):
+    """Parse and normalize a single input file of either format
+
+    Runs in a worker process, so it must not touch known_features.
+
+    :return: list of (pos, spec, exact) to be merged by merge_features
+    """
+    if filename.endswith('.geojson'):
+        return process_geojson(filename, offset, no_traders, no_tls)
+    return process_cc_json(filename, no_traders, no_tls)
 
 
 if __name__ == '__main__':
     epilog = \
         """    Caveats:
         - Only the first feature for any given map-position will be processed
+        - With --update, the existing export is preferred over all inputfiles
         - Remember to specify the correct spawn-offset for your world!
     TODO:
         - Importing landmarks / bases from the webmap not yet supported
@@ -208,26 +427,44 @@ if __name__ == '__main__':
     parser.add_argument('--offset', metavar='x,z', help="absolute pos of the world spawn", default='500000,500000')
     parser.add_argument('--notraders', action='store_true', help="Ignore all landmarks with Trader icon")
     parser.add_argument('--notls', action='store_true', help="Ignore all landmarks with Spiral icon")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="number of files parsed in parallel (default: number of cores)")
+    parser.add_argument('-u', '--update', action='store_true',
+                        help="append the inputfiles to an existing --output, using the index saved next to it")
 
     args = parser.parse_args()
     x, z = args.offset.split(',')
     offset = (int(x), int(z))
+    if args.update:
+        try:
+            known_features, tail_offset, size = FeatureIndex.load(index_path(args.output))
+        except IOError:
+            parser.error(f"--update needs {index_path(args.output)}, run a full merge first")
+        if os.path.exists(tail_backup_path(args.output)):
+            if os.path.exists(args.output) and os.path.getsize(args.output) != size:
+                log.warning(f"Undoing the unfinished last update of {args.output}")
+                restore_export(args.output)
+            else:  # The update finished, only removing the backup did not
+                os.remove(tail_backup_path(args.output))
+        if not os.path.exists(args.output) or os.path.getsize(args.output) != size:
+            parser.error(f"{args.output} was changed after {index_path(args.output)} was written, "
+                         f"run a full merge instead")
+    existing = len(known_features)
     map_features = []
-    for filename in args.inputfiles:
-        if filename.endswith('.geojson'):
-            process_geojson(filename, map_features, args.notraders, args.notls)
-        else:
-            process_cc_json(filename, map_features, args.notraders, args.notls)
-
-    outdata = {
-        "Name": f"Webmap Waypoints",
-        "World": args.worldname,
-        "Count": len(map_features),
-        "DateCreated": datetime.utcnow().isoformat(),
-        "Waypoints": map_features
-    }
-    log.info(f" Encountered {doublets} double landmarks")
-    log.info(f" Export File contains {len(map_features)} map features total.")
+    # Parse in parallel, but merge in the given order to keep preference and doublet handling stable
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        parsed = pool.map(parse_file, args.inputfiles,
+                          repeat(offset), repeat(args.notraders), repeat(args.notls))
+        for candidates in parsed:
+            merge_features(candidates, map_features)
 
-    with open(args.output, 'w') as f:
-        json.dump(outdata, f, indent=4)
+    log.info(f" Encountered {doublets} double landmarks")
+    log.info(f" Export File contains {existing + len(map_features)} map features total.")
+
+    if args.update:
+        tail_offset, size = append_export(args.output, tail_offset, existing, map_features)
+    else:
+        tail_offset, size = write_export(args.output, args.worldname, map_features)
+    known_features.save(index_path(args.output), tail_offset, size)
+    if args.update:
+        os.remove(tail_backup_path(args.output))
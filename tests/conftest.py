@@ -0,0 +1,45 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# lib.pathfinder.config parses the command line on import, keep pytest's options away from it
+sys.argv = [sys.argv[0], '--config', os.path.join(ROOT, 'config', 'config.yaml')]
+
+
+@pytest.fixture
+def make_world():
+    """Return a function importing random TL pairs, like a CC export would add them
+
+    Partners are placed close to each other, so the map has some structure to cut into cells.
+    """
+    from lib.pathfinder.importers import AbstractImporter
+
+    def make_world(num_pairs, seed=0, span=150000, partner_dist=20000, graph=None):
+        rng = np.random.default_rng(seed)
+        importer = AbstractImporter('synthetic', graph)
+        for _ in range(num_pairs):
+            ox, oz = rng.integers(-span, span, 2).tolist()
+            dx, dz = (ox + rng.integers(-partner_dist, partner_dist), oz + rng.integers(-partner_dist, partner_dist))
+            importer.add_tl((ox, 100, oz), (int(dx), 100, int(dz)))
+        importer.make_connections()
+        return importer
+    return make_world
+
+
+def route_length(legs):
+    return sum(step[2] for leg in legs for step in leg)
+
+
+def edge_set(graph):
+    """Undirected edges as sorted (position, position, weight, is_tl, disabled) rows"""
+    edges = graph.get_edges([graph.ep.weight, graph.ep.is_tl, graph.ep.disabled])
+    x, z = graph.vp.x.a, graph.vp.z.a
+    rows = []
+    for u, v, *props in edges.tolist():
+        ends = sorted([(int(x[u]), int(z[u])), (int(x[v]), int(z[v]))])
+        rows.append((*ends, *props))
+    return sorted(rows)
@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip('graph_tool')
+pytest.importorskip('textual')
+
+from conftest import edge_set
+from lib.pathfinder.commander import GraphCommander
+from lib.pathfinder.config import config
+from lib.pathfinder.navgraph import save_graph
+
+# A pair close enough to walk between its ends, and one spanning a longer distance
+PAIRS = [((1000, 2000), (4000, 2500)), ((-20000, 5000), (15000, -30000))]
+
+
+@pytest.fixture
+def commander(make_world, tmp_path, monkeypatch):
+    monkeypatch.setitem(config, 'data_file', str(tmp_path / 'navgraph.gt'))
+    monkeypatch.setitem(config, 'ore_file', str(tmp_path / 'ores.npz'))
+    graph = make_world(60, span=40000).graph
+    save_graph(graph, config['data_file'])
+    return GraphCommander(graph)
+
+
+def test_tl_add_matches_import(commander, make_world):
+    for origin, destination in PAIRS:
+        commander.add_tl(origin, destination)
+
+    importer = make_world(60, span=40000)  # Same seed, same world
+    for origin, destination in PAIRS:
+        importer.add_tl((origin[0], 100, origin[1]), (destination[0], 100, destination[1]))
+    importer.make_connections()
+
+    assert edge_set(commander.graph) == edge_set(importer.graph)
+
+
+def test_tl_add_walks_between_close_ends(commander):
+    origin, destination = PAIRS[0]
+    commander.add_tl(origin, destination)
+    graph = commander.graph
+    ends = graph.num_vertices() - 2, graph.num_vertices() - 1
+    weights = sorted((graph.ep.weight[e], bool(graph.ep.is_tl[e])) for e in graph.edge(*ends, all_edges=True))
+    assert (3500, False) in weights
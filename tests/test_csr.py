@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('graph_tool')
+pytest.importorskip('textual')
+
+from conftest import route_length
+from lib.pathfinder.commander import GraphCommander
+from lib.pathfinder.config import config
+from lib.pathfinder.navgraph import save_graph
+
+
+def random_stops(rng, num, stops=2, span=150000):
+    return [[tuple(pos) for pos in rng.integers(-span, span, (stops, 2)).tolist()] for _ in range(num)]
+
+
+def assert_same_lengths(commander, queries, legs):
+    for stops, found in zip(queries, legs):
+        assert route_length(found) == route_length(commander.find_route(stops, backend='graph_tool')), stops
+
+
+@pytest.fixture
+def csr_commander(make_world, tmp_path, monkeypatch):
+    monkeypatch.setitem(config, 'routing_backend', 'csr')
+    monkeypatch.setitem(config, 'data_file', str(tmp_path / 'navgraph.gt'))
+    monkeypatch.setitem(config, 'csr_dir', str(tmp_path / 'csr'))
+
+    def csr_commander(workers=0):
+        monkeypatch.setitem(config, 'route_workers', workers)
+        graph = make_world(300, seed=5).graph
+        save_graph(graph, config['data_file'])
+        return GraphCommander(graph)
+    return csr_commander
+
+
+def test_csr_routes_match_graph_tool(csr_commander):
+    commander = csr_commander()
+    rng = np.random.default_rng(6)
+    queries = random_stops(rng, 30) + random_stops(rng, 10, stops=3)
+    assert_same_lengths(commander, queries, [commander.find_route(stops) for stops in queries])
+
+
+def test_csr_follows_tl_edits(csr_commander):
+    commander = csr_commander()
+    rng = np.random.default_rng(7)
+    commander.add_tl((-100000, -100000), (100000, 100000))
+    queries = random_stops(rng, 20)
+    assert_same_lengths(commander, queries, [commander.find_route(stops) for stops in queries])
+
+    for stops in queries:
+        used = [step[0] for leg in commander.find_route(stops) for step in leg if step[3]]
+        for pos in used:
+            commander.set_tl_disabled(pos)
+    assert_same_lengths(commander, queries, [commander.find_route(stops) for stops in queries])
+
+
+def test_workers_follow_the_export(csr_commander):
+    commander = csr_commander(workers=2)
+    try:
+        rng = np.random.default_rng(8)
+        queries = random_stops(rng, 20)
+        assert_same_lengths(commander, queries, commander.workers.routes(queries))
+
+        # Added vertices reach the workers through the side file
+        commander.add_tl((-100000, -100000), (100000, 100000))
+        across = [[(-99000, -99000), (99000, 99000)]]
+        legs = commander.workers.routes(across)
+        assert any(step[3] for step in legs[0][0])
+        assert_same_lengths(commander, across, legs)
+
+        # Disabled edges through the shared map
+        commander.set_tl_disabled((-100000, -100000))
+        assert_same_lengths(commander, across + queries, commander.workers.routes(across + queries))
+    finally:
+        commander.workers.close(wait=True)
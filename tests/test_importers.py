@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('graph_tool')
+
+from conftest import edge_set
+from graph_tool.topology import shortest_distance
+from lib.pathfinder import importers
+from lib.pathfinder.importers import AbstractImporter
+
+
+def add_traders(importer, rng, count):
+    for i in range(count):
+        x, z = rng.integers(-150000, 150000, 2).tolist()
+        importer.add_trader((x, 100, z), f'trader {i}', 'food')
+
+
+def test_incremental_import_matches_full_import(make_world):
+    full = make_world(300, seed=5)
+    add_traders(full, np.random.default_rng(6), 40)
+    full.make_connections()
+
+    first = make_world(200, seed=5)
+    add_traders(first, np.random.default_rng(6), 40)
+    first.make_connections()
+    # Same TL as the full import, the first 200 of them already known
+    rest = make_world(300, seed=5, graph=first.graph)
+
+    assert edge_set(rest.graph) == edge_set(full.graph)
+
+
+def test_incremental_import_only_scans_new_vertices(make_world, monkeypatch):
+    graph = make_world(300, seed=7).graph
+    importer = AbstractImporter('synthetic', graph)
+    importer.add_tl((0, 100, 0), (5000, 100, 5000))
+    add_traders(importer, np.random.default_rng(8), 1)
+
+    calls = []
+    distances = importers.distances
+    monkeypatch.setattr(importers, 'distances', lambda *args: calls.append(args) or distances(*args))
+    importer.make_connections()
+    new = graph.num_vertices() - importer.first_new
+    assert 0 < len(calls) <= 3 * new  # One scan per new vertex and kind of link
+    assert importer.changed_vertices()[-new:] == list(range(importer.first_new, graph.num_vertices()))
+
+
+def test_sparsify_keeps_all_distances(make_world):
+    importer = make_world(150, seed=9, span=40000)
+    graph = importer.graph
+    before = [shortest_distance(graph, vt, weights=graph.ep.weight).a.copy() for vt in range(0, 300, 7)]
+    edges = graph.num_edges()
+    assert importer.sparsify() > 0
+    assert graph.num_edges() < edges
+    after = [shortest_distance(graph, vt, weights=graph.ep.weight).a for vt in range(0, 300, 7)]
+    for a, b in zip(before, after):
+        assert np.array_equal(a, b)
@@ -0,0 +1,101 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('graph_tool')
+
+from conftest import edge_set
+from lib.pathfinder import journal
+from lib.pathfinder.importers import AbstractImporter
+from lib.pathfinder.navgraph import save_graph, load_graph, journal_change, mark_changed, change_log
+
+MAX_SIZE = 10 ** 9
+
+
+def import_pairs(graph, path, pairs):
+    """Import TL pairs into graph in place and journal them like GraphCommander.do_import"""
+    importer = AbstractImporter('synthetic', graph)
+    for origin, destination in pairs:
+        importer.add_tl((origin[0], 100, origin[1]), (destination[0], 100, destination[1]))
+    importer.make_connections()
+    importer.sparsify()
+    mark_changed(graph, importer.changed_regions())
+    journal_change(graph, path, importer.changed_vertices(), MAX_SIZE)
+
+
+def assert_same(graph, other):
+    assert graph.num_vertices() == other.num_vertices()
+    assert edge_set(graph) == edge_set(other)
+    for name in ('x', 'z', 'is_tl', 'is_trader', 'is_landmark'):
+        assert np.array_equal(graph.vp[name].a, other.vp[name].a)
+    assert graph.gp.version == other.gp.version
+    assert np.array_equal(change_log(graph), change_log(other))
+
+
+@pytest.fixture
+def saved(make_world, tmp_path):
+    graph = make_world(40, seed=1, span=30000).graph
+    path = str(tmp_path / 'navgraph.gt')
+    save_graph(graph, path)
+    return graph, path
+
+
+def test_replay_restores_every_change(saved):
+    graph, path = saved
+    rng = np.random.default_rng(2)
+    for _ in range(3):
+        origin, destination = rng.integers(-30000, 30000, (2, 2)).tolist()
+        import_pairs(graph, path, [(origin, destination)])
+    edge = graph.get_edges([graph.edge_index, graph.ep.is_tl])
+    tl_edges = edge[edge[:, 3] == 1]
+    graph.ep.disabled.a[tl_edges[0, 2]] = True
+    mark_changed(graph, [(0, 0, 1, 1)])
+    journal_change(graph, path, tl_edges[0, :2].tolist(), MAX_SIZE)
+
+    assert_same(load_graph(path), graph)
+
+
+def test_damaged_record_ends_the_replay(saved):
+    graph, path = saved
+    import_pairs(graph, path, [((1000, 1000), (2000, 2000))])
+    expected = load_graph(path)
+    import_pairs(graph, path, [((-1000, -1000), (-2000, -2000))])
+    log_path = journal.journal_path(path)
+    with open(log_path, 'rb+') as f:
+        f.truncate(os.path.getsize(log_path) - 10)  # Crash while appending the last record
+
+    assert_same(load_graph(path), expected)
+    # The damaged journal was folded into a new snapshot
+    records, intact = journal.read(log_path, load_graph(path).gp.journal_base)
+    assert intact and not records
+
+
+def test_journal_of_another_snapshot_is_ignored(saved):
+    graph, path = saved
+    import_pairs(graph, path, [((1000, 1000), (2000, 2000))])
+    log_path = journal.journal_path(path)
+    with open(log_path) as f:
+        stale = f.read()
+    save_graph(graph, path)
+    expected = load_graph(path)
+    import_pairs(graph, path, [((-1000, -1000), (-2000, -2000))])
+    with open(log_path, 'w') as f:
+        f.write(stale)  # e.g. a crash between replacing the snapshot and starting its journal
+
+    assert_same(load_graph(path), expected)
+
+
+def test_snapshot_is_synced_before_it_replaces_the_old_one(saved, monkeypatch):
+    graph, path = saved
+    events = []
+    fsync, replace = os.fsync, os.replace
+    monkeypatch.setattr(os, 'fsync', lambda fd: events.append(('fsync', os.readlink(f'/proc/self/fd/{fd}'))) or fsync(fd))
+    monkeypatch.setattr(os, 'replace', lambda src, dst: events.append(('replace', str(dst))) or replace(src, dst))
+    save_graph(graph, path)
+
+    synced = events.index(('fsync', path + '.tmp'))
+    replaced = events.index(('replace', path))
+    directory = events.index(('fsync', os.path.dirname(path)))
+    assert synced < replaced < directory
+    assert events[-1][0] == 'fsync'  # The new journal is durable as well
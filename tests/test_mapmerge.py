@@ -0,0 +1,108 @@
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+from conftest import ROOT
+from mapmerge import FeatureIndex, DOUBLET_DIST, index_path, tail_backup_path, append_export
+
+
+def write_tls(path, pairs):
+    """Write a webmap translocators.geojson"""
+    features = [{'geometry': {'coordinates': [list(a), list(b)]}, 'properties': {'depth1': 100, 'depth2': 110}}
+                for a, b in pairs]
+    with open(path, 'w') as f:
+        json.dump({'name': 'translocators', 'features': features}, f)
+    return str(path)
+
+
+def merge(*args):
+    subprocess.run([sys.executable, os.path.join(ROOT, 'mapmerge.py'), *map(str, args)], check=True,
+                   capture_output=True)
+
+
+def waypoints(path):
+    with open(path) as f:
+        export = json.load(f)
+    assert export['Count'] == len(export['Waypoints'])
+    return [(wp['Position']['X'], wp['Position']['Z']) for wp in export['Waypoints']]
+
+
+def random_pairs(rng, num):
+    return [tuple(map(tuple, pair)) for pair in rng.integers(-5000, 5000, (num, 2, 2)).tolist()]
+
+
+def test_update_matches_full_merge(tmp_path):
+    rng = np.random.default_rng(1)
+    first = write_tls(tmp_path / 'first.geojson', random_pairs(rng, 50))
+    repeated = random_pairs(np.random.default_rng(1), 10)  # Already in first, doublets of the loaded index
+    second = write_tls(tmp_path / 'second.geojson', random_pairs(rng, 50) + repeated)
+
+    merge(first, second, '-o', tmp_path / 'full.json')
+    merge(first, '-o', tmp_path / 'updated.json')
+    merge(second, '-o', tmp_path / 'updated.json', '--update')
+    assert waypoints(tmp_path / 'updated.json') == waypoints(tmp_path / 'full.json')
+    assert not os.path.exists(tail_backup_path(str(tmp_path / 'updated.json')))
+
+
+def test_update_undoes_an_interrupted_append(tmp_path):
+    rng = np.random.default_rng(2)
+    first = write_tls(tmp_path / 'first.geojson', random_pairs(rng, 20))
+    second = write_tls(tmp_path / 'second.geojson', random_pairs(rng, 20))
+    output = str(tmp_path / 'export.json')
+    merge(first, '-o', output)
+    expected = waypoints(output)
+
+    # Crash after appending but before the index was saved
+    index, tail_offset, size = FeatureIndex.load(index_path(output))
+    append_export(output, tail_offset, len(index), [{'Position': {'X': 1, 'Y': 2, 'Z': 3}}])
+    merge(second, '-o', output, '--update')
+    merge(second, '-o', tmp_path / 'clean.json')
+    assert waypoints(output) == expected + [pos for pos in waypoints(tmp_path / 'clean.json') if pos not in expected]
+    assert not os.path.exists(tail_backup_path(output))
+
+
+def test_update_keeps_a_finished_append(tmp_path):
+    rng = np.random.default_rng(3)
+    first = write_tls(tmp_path / 'first.geojson', random_pairs(rng, 20))
+    output = str(tmp_path / 'export.json')
+    merge(first, '-o', output)
+    merge(write_tls(tmp_path / 'second.geojson', random_pairs(rng, 20)), '-o', output, '--update')
+    expected = waypoints(output)
+
+    # Crash after saving the index but before removing the backup
+    with open(tail_backup_path(output), 'w') as f:
+        f.write('0\n')
+    merge(first, '-o', output, '--update')  # Nothing new
+    assert waypoints(output) == expected
+    assert not os.path.exists(tail_backup_path(output))
+
+
+def test_find_doublet_matches_brute_force(tmp_path):
+    rng = np.random.default_rng(4)
+    positions = [tuple(pos) for pos in rng.integers(-200, 200, (300, 2)).tolist()]
+    kinds = [('trader', int(t)) if t else ('spiral', 0) for t in rng.integers(0, 3, 300).tolist()]
+
+    index = FeatureIndex()
+    for pos, (icon, trader_type) in zip(positions[:200], kinds[:200]):
+        index.add(pos, icon, trader_type)
+    path = str(tmp_path / 'index.npz')
+    index.save(path, 0, 0)
+    loaded, _, _ = FeatureIndex.load(path)
+    for pos, (icon, trader_type) in zip(positions[200:250], kinds[200:250]):
+        index.add(pos, icon, trader_type)
+        loaded.add(pos, icon, trader_type)
+    known = list(zip(positions[:250], kinds[:250]))
+
+    for pos, kind in zip(positions[250:] + positions[:20], kinds[250:] + kinds[:20]):
+        near = {i for i, (other, other_kind) in enumerate(known)
+                if other_kind == kind and abs(other[0] - pos[0]) + abs(other[1] - pos[1]) < DOUBLET_DIST}
+        for features in (index, loaded):
+            found = features.find_doublet(pos, *kind)
+            if near:
+                assert found in near
+            else:
+                assert found is None
+            assert (pos in features) == (pos in positions[:250])
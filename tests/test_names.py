@@ -0,0 +1,59 @@
+import random
+
+from lib.pathfinder.names import NameIndex, MAX_EDITS
+
+ALPHABET = 'abcde '  # Few letters, so many names are close to each other
+
+
+def levenshtein(a, b):
+    previous = list(range(len(b) + 1))
+    for i, char in enumerate(a, 1):
+        current = [i]
+        for j, other in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != other)))
+        previous = current
+    return previous[-1]
+
+
+def mutate(rng, name, edits):
+    for _ in range(edits):
+        i = rng.randrange(len(name) + 1)
+        op = rng.choice('isd') if name else 'i'
+        if op == 'i':
+            name = name[:i] + rng.choice(ALPHABET) + name[i:]
+        elif i < len(name):
+            name = name[:i] + (rng.choice(ALPHABET) if op == 's' else '') + name[i + 1:]
+    return name
+
+
+def random_names(rng, num):
+    return [''.join(rng.choice(ALPHABET) for _ in range(rng.randint(1, 14))) for _ in range(num)]
+
+
+def test_fuzzy_matches_brute_force():
+    rng = random.Random(1)
+    names = random_names(rng, 400)
+    index = NameIndex((name.title(), vt) for vt, name in enumerate(names))
+    distinct = set(names)
+
+    queries = [mutate(rng, rng.choice(names), rng.randint(0, 3)) for _ in range(300)] + random_names(rng, 50)
+    for query in queries:
+        dists = {name: levenshtein(query, name) for name in distinct}
+        for max_dist in range(MAX_EDITS + 1):
+            found = index.fuzzy(query.upper(), max_dist)
+            assert set(found) == {name for name, dist in dists.items() if dist <= max_dist}, (query, max_dist)
+            assert [dists[name] for name in found] == sorted(dists[name] for name in found)
+
+
+def test_exact_and_prefix():
+    rng = random.Random(2)
+    names = random_names(rng, 300)
+    index = NameIndex((name, vt) for vt, name in enumerate(names))
+
+    for query in rng.sample(names, 50) + random_names(rng, 20):
+        assert sorted(index.exact(query)) == [vt for vt, name in enumerate(names) if name == query]
+        matching = sorted({name for name in names if name.startswith(query)})
+        assert index.prefix(query) == matching
+        common, candidates = index.complete(query)
+        assert candidates == matching
+        assert all(name.startswith(common) for name in matching) and common.startswith(query)
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('graph_tool')
+
+from lib.pathfinder.importers import AbstractImporter
+from lib.pathfinder.navgraph import Categories
+
+DESCRIPTIONS = ['artisan', 'food', 'glass', 'nothing known']
+
+
+def add_features(importer, rng, count):
+    for i in range(count):
+        x, z = rng.integers(-50000, 50000, 2).tolist()
+        if i % 2:
+            importer.add_trader((x, 100, z), f'trader {i}', DESCRIPTIONS[i % len(DESCRIPTIONS)])
+        else:
+            importer.add_landmark((x, 100, z), f'landmark {i}', landmark_type=i % 3)
+
+
+def test_categories_add_matches_rebuild(make_world):
+    rng = np.random.default_rng(0)
+    importer = make_world(20)
+    add_features(importer, rng, 30)
+    categories = Categories(importer.graph)
+
+    first_new = importer.graph.num_vertices()
+    importer = make_world(5, seed=1, graph=importer.graph)
+    add_features(importer, rng, 20)
+    categories.add(importer.graph, range(first_new, importer.graph.num_vertices()))
+
+    rebuilt = Categories(importer.graph)
+    for name in ('tl', 'traders', 'landmarks'):
+        assert np.array_equal(getattr(categories, name), getattr(rebuilt, name))
+    for trader_type in range(13):
+        assert np.array_equal(categories.traders_of(trader_type), rebuilt.traders_of(trader_type))
+    for landmark_type in range(3):
+        assert np.array_equal(categories.landmarks_of(landmark_type), rebuilt.landmarks_of(landmark_type))
+        assert categories.landmarks_of(landmark_type).size
+
+
+def test_categories_of_empty_graph_keep_types_apart(make_world):
+    importer = make_world(2)
+    add_features(importer, np.random.default_rng(2), 6)
+    categories = Categories()
+    categories.add(importer.graph, range(importer.graph.num_vertices()))
+    assert categories.traders_by_type is not categories.landmarks_by_type
+    assert np.array_equal(categories.landmarks, Categories(importer.graph).landmarks)
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('graph_tool')
+pytest.importorskip('textual')
+
+from conftest import route_length
+from lib.pathfinder.commander import GraphCommander
+from lib.pathfinder.config import config
+
+
+def test_overlay_routes_match_dijkstra(make_world, monkeypatch):
+    monkeypatch.setitem(config, 'routing_backend', 'overlay')
+    monkeypatch.setitem(config, 'overlay_cell_size', 80000)
+    graph = make_world(400, seed=1).graph
+    commander = GraphCommander(graph)
+    assert commander.overlay.boundary_fraction() < 1
+
+    rng = np.random.default_rng(2)
+    for _ in range(60):
+        stops = [tuple(pos) for pos in rng.integers(-150000, 150000, (2, 2)).tolist()]
+        exact = commander.find_route(stops, backend='graph_tool')
+        overlay = commander.find_route(stops, backend='overlay')
+        assert route_length(overlay) == route_length(exact), stops
+
+
+def test_overlay_via_points(make_world, monkeypatch):
+    monkeypatch.setitem(config, 'routing_backend', 'overlay')
+    monkeypatch.setitem(config, 'overlay_cell_size', 80000)
+    commander = GraphCommander(make_world(200, seed=3).graph)
+
+    rng = np.random.default_rng(4)
+    for _ in range(10):
+        stops = [tuple(pos) for pos in rng.integers(-150000, 150000, (3, 2)).tolist()]
+        assert route_length(commander.find_route(stops, backend='overlay')) == \
+            route_length(commander.find_route(stops, backend='graph_tool'))
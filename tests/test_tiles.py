@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+pytest.importorskip('graph_tool')
+
+from lib.pathfinder.importers import AbstractImporter
+from lib.pathfinder.navgraph import mark_changed
+from lib.pathfinder.tiles import TileRenderer, tile_blocks
+
+ZOOM = 3
+
+
+def tiles(tile_dir):
+    directory = os.path.join(tile_dir, str(ZOOM))
+    return {name: os.stat(os.path.join(directory, name)).st_mtime_ns for name in os.listdir(directory)}
+
+
+def tile_of(pos):
+    size = tile_blocks(ZOOM)
+    return f"{pos[0] // size}_{pos[1] // size}.png"
+
+
+def import_pairs(graph, pairs):
+    importer = AbstractImporter('synthetic', graph)
+    for origin, destination in pairs:
+        importer.add_tl((origin[0], 100, origin[1]), (destination[0], 100, destination[1]))
+    importer.make_connections()
+    mark_changed(importer.graph, importer.changed_regions())
+    return importer.graph
+
+
+def test_far_apart_import_keeps_tiles_in_between(make_world, tmp_path):
+    graph = make_world(60, seed=1, span=60000, partner_dist=5000).graph
+    graph = import_pairs(graph, [((0, 0), (500, 500))])
+    TileRenderer(str(tmp_path)).render(graph, [ZOOM])
+    before = tiles(tmp_path)
+
+    corners = [(-90000, -90000), (90000, 90000)]
+    graph = import_pairs(graph, [(corners[0], corners[1])])
+    rendered = TileRenderer(str(tmp_path)).render(graph, [ZOOM])
+    after = tiles(tmp_path)
+
+    assert tile_of(corners[0]) in after and tile_of(corners[1]) in after
+    assert rendered < len(before) / 2
+    # The map between both ends was not touched and keeps its tiles
+    assert tile_of((0, 0)) in before and after[tile_of((0, 0))] == before[tile_of((0, 0))]
+
+
+def test_tile_left_empty_is_deleted(make_world, tmp_path):
+    graph = make_world(20, seed=2, span=30000, partner_dist=3000).graph
+    lonely = (200000, 200000)
+    graph = import_pairs(graph, [(lonely, (lonely[0] + 100, lonely[1] + 100))])
+    renderer = TileRenderer(str(tmp_path))
+    renderer.render(graph, [ZOOM])
+    assert tile_of(lonely) in tiles(tmp_path)
+
+    graph.remove_vertex([graph.num_vertices() - 2, graph.num_vertices() - 1])
+    mark_changed(graph, [(lonely[0] - 10, lonely[1] - 10, lonely[0] + 110, lonely[1] + 110)])
+    TileRenderer(str(tmp_path)).render(graph, [ZOOM])
+    assert tile_of(lonely) not in tiles(tmp_path)
+
+
+def test_other_graph_starts_over(make_world, tmp_path):
+    first = make_world(20, seed=3, span=30000, partner_dist=3000).graph
+    TileRenderer(str(tmp_path)).render(first, [ZOOM])
+    second = make_world(20, seed=4, span=30000, partner_dist=3000).graph  # Same version as first
+    rendered = TileRenderer(str(tmp_path)).render(second, [ZOOM])
+
+    # Every tile left was drawn from the second graph
+    assert rendered == len(tiles(tmp_path))
+    assert {tile_of(pos) for pos in zip(second.vp.x.a.tolist(), second.vp.z.a.tolist())} <= set(tiles(tmp_path))